@@ -18,13 +18,21 @@ Copyright (c) 2022 Daumantas Kavolis
 
 """
 
-# pyright: reportUnusedImport=false
-
-from buildtools import (  # noqa: F401
-    common,
-    postbuild,
-    replace,
-    package,
-    burst_compile,
-    datatypes,
-)
+import importlib
+from typing import Any
+
+__all__ = [
+    "common",
+    "postbuild",
+    "replace",
+    "package",
+    "burst_compile",
+    "datatypes",
+]
+
+
+def __getattr__(name: str) -> Any:
+    # submodules are only imported on first access to keep startup fast
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -20,46 +20,59 @@ Copyright (c) 2022 Daumantas Kavolis
 
 
 import argparse
+import importlib
 import json
+import pathlib
 import pprint
-from buildtools import common, package, postbuild, replace, burst_compile
-from buildtools.datatypes import JSONEncoder
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple
+from buildtools import common
+from buildtools.datatypes import Config, JSONEncoder
 import logging
 
+# command: (module, description), modules are only imported when selected
+COMMANDS: Dict[str, Tuple[str, str]] = {
+    "replace": ("buildtools.replace", "Regex replacement utility"),
+    "package": ("buildtools.package", "Archive utility"),
+    "postbuild": ("buildtools.postbuild", "Post build utility"),
+    "burst_compile": ("buildtools.burst_compile", "Burst compiler utility"),
+    "serve": ("buildtools.server", "Resident build server"),
+}
 
-def main():
-    logging.basicConfig()
 
-    parser = argparse.ArgumentParser("C# build helpers", add_help=False)
+def load_command(name: str) -> ModuleType:
+    return importlib.import_module(COMMANDS[name][0])
+
 
+def selected_command(argv: Optional[List[str]] = None) -> Optional[str]:
+    parser = argparse.ArgumentParser(add_help=False)
     common.add_config_option(parser)
-    subparsers = parser.add_subparsers(description="Available helpers", dest="command")
+    parser.add_argument("--dump-config", action="store", default=0, nargs="?")
+    parser.add_argument("command", nargs="?")
+
+    args, _ = parser.parse_known_args(argv)
+    if args.command in COMMANDS:
+        return args.command
+    return None
 
-    replacer = subparsers.add_parser(
-        "replace", description="Regex replacement utility", parents=[parser]
-    )
-    packager = subparsers.add_parser(
-        "package", description="Archive utility", parents=[parser]
-    )
-    post = subparsers.add_parser(
-        "postbuild", description="Post build utility", parents=[parser]
-    )
-    burst_compiler = subparsers.add_parser(
-        "burst_compile", description="Burst compiler utility", parents=[parser]
-    )
 
-    # args.command always contains None so add defaults
-    replace.build_parser(replacer)
-    replacer.set_defaults(run=replace.run)
+def build_parser(command: Optional[str]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser("C# build helpers", add_help=False)
 
-    package.build_parser(packager)
-    packager.set_defaults(run=package.run)
+    common.add_config_option(parser)
+    subparsers = parser.add_subparsers(description="Available helpers", dest="command")
 
-    postbuild.build_parser(post)
-    post.set_defaults(run=postbuild.run)
+    for name, (_, description) in COMMANDS.items():
+        subparser = subparsers.add_parser(
+            name, description=description, parents=[parser]
+        )
+        if name != command:
+            continue
 
-    burst_compile.build_parser(burst_compiler)
-    burst_compiler.set_defaults(run=burst_compile.run)
+        # args.command always contains None so add defaults
+        module = load_command(name)
+        module.build_parser(subparser)
+        subparser.set_defaults(run=module.run)
 
     parser.add_argument(
         "-h",
@@ -70,10 +83,22 @@ def main():
     )
     parser.add_argument("--dump-config", action="store", default=0, nargs="?")
 
-    args = parser.parse_args()
+    return parser
+
+
+def parse_args(
+    argv: Optional[List[str]] = None,
+) -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
+    parser = build_parser(selected_command(argv))
+    args = parser.parse_args(argv)
+    # commands run from the config root so make sure the config can still be found
+    args.config = str(pathlib.Path(args.config).absolute())
+    return parser, args
 
-    config = common.load_config(args.config)
 
+def execute(
+    config: Config, args: argparse.Namespace, parser: argparse.ArgumentParser
+) -> None:
     if args.dump_config != 0:
         if args.dump_config:
             with open(args.dump_config, "w") as file:
@@ -82,12 +107,26 @@ def main():
             pprint.pprint(config)
         return
 
+    start = common.counters.copy()
     with common.chdir(config.root):
         if hasattr(args, "run"):
             args.run(config, args)
         else:
             parser.print_help()
 
+    if getattr(args, "verbose", 0) > 0:
+        stats = common.counters.copy()
+        stats.subtract(start)
+        common.print_stats(stats)
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig()
+
+    parser, args = parse_args(argv)
+    config = common.load_config(args.config, args.config_cache)
+    execute(config, args, parser)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import pathlib
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from buildtools.datatypes import PathLike
+
+CHUNK_SIZE = 1 << 20
+# compressed streams larger than this are spooled to disk until they are written
+SPOOL_SIZE = 8 << 20
+
+# pseudo compression type, files are deflated unless a sample compresses poorly
+AUTO = -1
+SAMPLE_SIZE = 64 << 10
+AUTO_RATIO = 0.9
+
+
+def auto_compression(filename: PathLike) -> int:
+    with open(filename, "rb") as file:
+        sample = file.read(SAMPLE_SIZE)
+    if not sample:
+        return zipfile.ZIP_DEFLATED
+    compressed = zlib.compress(sample, 1)
+    if len(compressed) >= AUTO_RATIO * len(sample):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class CompressionPolicy(object):
+    """Compression type for each archive name, the first matching rule is used"""
+
+    def __init__(self, default: int, rules: Sequence[Tuple[str, int]] = ()):
+        self.default = default
+        self.rules = list(rules)
+
+    def select(self, arcname: str) -> int:
+        path = pathlib.PurePosixPath(arcname)
+        for pattern, compress_type in self.rules:
+            if path.match(pattern):
+                return compress_type
+        return self.default
+
+
+class CompressedEntry(object):
+    def __init__(
+        self,
+        info: zipfile.ZipInfo,
+        data: Optional[IO[bytes]],
+        seconds: float = 0,
+        auto: bool = False,
+        reused: bool = False,
+    ):
+        self.info = info
+        self.data = data
+        self.seconds = seconds
+        self.auto = auto
+        self.reused = reused
+
+    def close(self) -> None:
+        if self.data is not None:
+            self.data.close()
+
+
+def compress_entry(
+    filename: PathLike,
+    arcname: str,
+    compress_type: int,
+    compresslevel: Optional[int] = None,
+    strict_timestamps: bool = True,
+) -> CompressedEntry:
+    start = time.perf_counter()
+    info = zipfile.ZipInfo.from_file(
+        filename, arcname, strict_timestamps=strict_timestamps
+    )
+    if info.is_dir():
+        return CompressedEntry(info, None)
+
+    auto = compress_type == AUTO
+    if auto:
+        compress_type = auto_compression(filename)
+
+    info.compress_type = compress_type
+    info._compresslevel = compresslevel  # type: ignore
+    # same flags as ZipFile.open(..., "w") sets for seekable files
+    info.flag_bits = 0
+    if compress_type == zipfile.ZIP_LZMA:
+        info.flag_bits |= zipfile._MASK_COMPRESS_OPTION_1  # type: ignore
+
+    compressor = zipfile._get_compressor(  # type: ignore
+        compress_type, compresslevel
+    )
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = 0
+    file_size = 0
+    with open(filename, "rb") as src:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            data.write(chunk)
+    if compressor is not None:
+        data.write(compressor.flush())
+
+    info.CRC = crc
+    info.file_size = file_size
+    info.compress_size = data.tell()
+    data.seek(0)
+    return CompressedEntry(info, data, time.perf_counter() - start, auto)
+
+
+def write_compressed(zip: zipfile.ZipFile, entry: CompressedEntry) -> None:
+    """Write an already compressed entry, the output is the same as ZipFile.write"""
+    info = entry.info
+    if zip._writing:  # type: ignore
+        raise ValueError("Can't write to ZIP archive while an open handle exists")
+
+    if entry.data is None:
+        # ZipFile.mkdir only exists since python 3.11, directories are just a header
+        info.file_size = 0
+        info.compress_size = 0
+        info.CRC = 0
+        zip64 = False
+    else:
+        # same as ZipFile._open_to_write, compressed size can be larger than file size
+        zip64 = info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zip64 = zip64 or info.compress_size > zipfile.ZIP64_LIMIT
+        if zip64 and not zip._allowZip64:  # type: ignore
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        if not info.external_attr:
+            info.external_attr = 0o600 << 16
+
+    with zip._lock:  # type: ignore
+        if zip._seekable:  # type: ignore
+            zip.fp.seek(zip.start_dir)  # type: ignore
+        info.header_offset = zip.fp.tell()  # type: ignore
+        zip._writecheck(info)  # type: ignore
+        zip._didModify = True  # type: ignore
+
+        zip.fp.write(info.FileHeader(zip64))  # type: ignore
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = entry.data.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                raise EOFError(f"Compressed data of {info.filename} is truncated")
+            zip.fp.write(chunk)  # type: ignore
+            remaining -= len(chunk)
+
+        zip.filelist.append(info)
+        zip.NameToInfo[info.filename] = info
+        zip.start_dir = zip.fp.tell()  # type: ignore
+
+
+class ArchiveSlice(object):
+    # compressed data of an entry in another archive, the file may be shared by
+    # several slices so always seek before reading
+    def __init__(self, fp: IO[bytes], offset: int, size: int):
+        self.fp = fp
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def read(self, n: int = -1) -> bytes:
+        remaining = self.size - self.position
+        if n < 0 or n > remaining:
+            n = remaining
+        self.fp.seek(self.offset + self.position)
+        data = self.fp.read(n)
+        self.position += len(data)
+        return data
+
+    def close(self) -> None:
+        pass
+
+
+def file_crc(filename: PathLike) -> int:
+    crc = 0
+    with open(filename, "rb") as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+
+class PreviousArchive(object):
+    """Reuses compressed data of unchanged files from a previously written archive
+
+    An entry is unchanged if the size and CRC32 of the source match the archive. Zip
+    timestamps only have a 2 second resolution so they can't tell a file rewritten
+    with the same size apart, and reading is still much cheaper than compressing.
+    """
+
+    def __init__(self, filename: PathLike):
+        self.zip = zipfile.ZipFile(filename, "r")
+        self.reused = 0
+
+    def close(self) -> None:
+        self.zip.close()
+
+    def __enter__(self) -> PreviousArchive:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def reuse(
+        self,
+        filename: PathLike,
+        arcname: str,
+        compress_type: int,
+        strict_timestamps: bool = True,
+    ) -> Optional[CompressedEntry]:
+        info = zipfile.ZipInfo.from_file(
+            filename, arcname, strict_timestamps=strict_timestamps
+        )
+        old = self.zip.NameToInfo.get(info.filename)
+        # encrypted entries can't be copied as is
+        if old is None or old.is_dir() or old.flag_bits & 0x1:
+            return None
+        if info.is_dir():
+            return None
+        if compress_type == AUTO:
+            # unchanged contents would get the same compression
+            if old.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                return None
+        elif old.compress_type != compress_type:
+            return None
+        if info.file_size != old.file_size:
+            return None
+        if file_crc(filename) != old.CRC:
+            return None
+
+        fp = self.zip.fp
+        assert fp is not None
+        fp.seek(old.header_offset)
+        header = struct.unpack(
+            zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader)
+        )
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:  # type: ignore
+            return None
+        offset = (
+            old.header_offset
+            + zipfile.sizeFileHeader
+            + header[zipfile._FH_FILENAME_LENGTH]  # type: ignore
+            + header[zipfile._FH_EXTRA_FIELD_LENGTH]  # type: ignore
+        )
+
+        info.compress_type = old.compress_type
+        info.flag_bits = old.flag_bits & zipfile._MASK_COMPRESS_OPTION_1  # type: ignore
+        info.CRC = old.CRC
+        info.file_size = old.file_size
+        info.compress_size = old.compress_size
+        self.reused += 1
+        data = ArchiveSlice(fp, offset, old.compress_size)
+        return CompressedEntry(info, data, reused=True)
+
+
+class MethodStats(object):
+    def __init__(self) -> None:
+        self.files = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.seconds = 0.0
+
+
+class ArchiveStats(object):
+    def __init__(self) -> None:
+        self.methods: Dict[int, MethodStats] = collections.defaultdict(MethodStats)
+        self.reused = MethodStats()
+        self.auto_stored = MethodStats()
+
+    def record(self, entry: CompressedEntry) -> None:
+        info = entry.info
+        if info.is_dir():
+            return
+
+        if entry.reused:
+            stats = [self.reused]
+        else:
+            stats = [self.methods[info.compress_type]]
+            if entry.auto and info.compress_type == zipfile.ZIP_STORED:
+                stats.append(self.auto_stored)
+
+        for s in stats:
+            s.files += 1
+            s.file_size += info.file_size
+            s.compress_size += info.compress_size
+            s.seconds += entry.seconds
+
+    def report(self) -> None:
+        for compress_type, s in sorted(self.methods.items()):
+            name = zipfile.compressor_names.get(compress_type, str(compress_type))
+            print(
+                f"{name}: {s.files} files, {format_size(s.file_size)} -> "
+                f"{format_size(s.compress_size)} in {s.seconds:.2f} s"
+            )
+        if self.reused.files:
+            print(
+                f"reused: {self.reused.files} files, "
+                f"{format_size(self.reused.compress_size)}"
+            )
+
+        # estimate what deflating the stored files would have cost
+        stored = self.methods.get(zipfile.ZIP_STORED)
+        deflated = self.methods.get(zipfile.ZIP_DEFLATED)
+        if stored is not None and deflated is not None and deflated.seconds > 0:
+            skipped = stored.file_size * deflated.seconds / deflated.file_size
+            print(
+                f"Storing {stored.files} files skipped an estimated {skipped:.2f} s "
+                "of compression"
+            )
+        if self.auto_stored.files:
+            print(
+                f"auto: stored {self.auto_stored.files} poorly compressible files, "
+                f"{format_size(self.auto_stored.file_size)}"
+            )
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def write_file(
+    zip: zipfile.ZipFile,
+    filename: PathLike,
+    arcname: str,
+    compress_type: int,
+    stats: Optional[ArchiveStats] = None,
+) -> None:
+    start = time.perf_counter()
+    auto = compress_type == AUTO
+    if auto and not pathlib.Path(filename).is_dir():
+        compress_type = auto_compression(filename)
+    elif auto:
+        compress_type = zip.compression
+
+    count = len(zip.filelist)
+    zip.write(filename, arcname, compress_type)
+    if stats is not None and len(zip.filelist) > count:
+        seconds = time.perf_counter() - start
+        stats.record(CompressedEntry(zip.filelist[-1], None, seconds, auto))
+
+
+def completed(entry: CompressedEntry) -> concurrent.futures.Future[CompressedEntry]:
+    future: concurrent.futures.Future[CompressedEntry] = concurrent.futures.Future()
+    future.set_result(entry)
+    return future
+
+
+def write_entries(
+    zip: zipfile.ZipFile,
+    entries: Iterable[Tuple[PathLike, str]],
+    jobs: int = 1,
+    previous: Optional[PreviousArchive] = None,
+    callback: Optional[Callable[[PathLike, str], None]] = None,
+    policy: Optional[CompressionPolicy] = None,
+    stats: Optional[ArchiveStats] = None,
+) -> None:
+    """Write files to the archive in the given order
+
+    With more than one job, entries are compressed on a thread pool since zlib, bz2 and
+    lzma release the GIL while compressing. At most 2 * jobs compressed entries are held
+    at a time. Unchanged entries of the previous archive are copied without
+    recompressing them.
+    """
+    if policy is None:
+        policy = CompressionPolicy(zip.compression)
+    compresslevel = zip.compresslevel
+    strict_timestamps = zip._strict_timestamps  # type: ignore
+
+    pending: Deque[
+        Tuple[PathLike, str, concurrent.futures.Future[CompressedEntry]]
+    ] = collections.deque()
+
+    def write_next() -> None:
+        filename, arcname, future = pending.popleft()
+        entry = future.result()
+        try:
+            if callback is not None:
+                callback(filename, arcname)
+            write_compressed(zip, entry)
+        finally:
+            entry.close()
+        if stats is not None:
+            stats.record(entry)
+
+    executor = None
+    if jobs > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    try:
+        for filename, arcname in entries:
+            compress_type = policy.select(arcname)
+            entry = None
+            if previous is not None:
+                entry = previous.reuse(
+                    filename, arcname, compress_type, strict_timestamps
+                )
+
+            if entry is not None:
+                future = completed(entry)
+            elif executor is None:
+                while pending:
+                    write_next()
+                if callback is not None:
+                    callback(filename, arcname)
+                write_file(zip, filename, arcname, compress_type, stats)
+                continue
+            else:
+                future = executor.submit(
+                    compress_entry,
+                    filename,
+                    arcname,
+                    compress_type,
+                    compresslevel,
+                    strict_timestamps,
+                )
+
+            pending.append((filename, arcname, future))
+            if len(pending) >= 2 * jobs:
+                write_next()
+
+        while pending:
+            write_next()
+    finally:
+        # don't compress the rest if writing failed
+        for _, _, future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown()
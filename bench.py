@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import re
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Mapping
+
+from buildtools import common
+from buildtools.__main__ import COMMANDS
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name: str, seconds: float) -> None:
+    print(f"{name:<40} {seconds * 1000:10.3f} ms")
+
+
+def variable_chain(depth: int) -> Dict[str, Any]:
+    variables: Dict[str, Any] = {"Var0": "root/"}
+    for i in range(1, depth):
+        variables[f"Var{i}"] = f"$(Var{i - 1})dir{i}/"
+    return variables
+
+
+def rescan_variables(variables: Mapping[str, Any]) -> Dict[str, Any]:
+    # the previous implementation: rescan each string until no substitutions are left
+    data = dict(variables)
+
+    def _re_sub(matchobj: re.Match[str]) -> str:
+        return str(data.get(matchobj.group(1), ""))
+
+    for name, value in data.items():
+        if not isinstance(value, str):
+            continue
+        newstr, subs = common.VAR_PATTERN.subn(_re_sub, value)
+        while subs > 0:
+            newstr, subs = common.VAR_PATTERN.subn(_re_sub, newstr)
+        data[name] = newstr
+    return data
+
+
+def bench_variables(args: argparse.Namespace) -> None:
+    variables = variable_chain(args.depth)
+    # keep the chain order reversed so that the rescans can't reuse earlier results
+    variables = dict(reversed(list(variables.items())))
+
+    resolved = common.resolve_variables(variables)
+    if args.depth <= args.rescan_limit:
+        assert resolved == rescan_variables(variables)
+        report(
+            f"rescan (depth {args.depth})",
+            measure(lambda: rescan_variables(variables), args.repeat),
+        )
+    report(
+        f"dependency graph (depth {args.depth})",
+        measure(lambda: common.resolve_variables(variables), args.repeat),
+    )
+
+
+# modules that a postbuild invocation doesn't need
+STARTUP_HEAVY_MODULES = [
+    "zipfile",
+    "subprocess",
+    "xml.etree.ElementTree",
+    "buildtools.package",
+    "buildtools.archive",
+    "buildtools.replace",
+    "buildtools.burst_compile",
+]
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import buildtools.__main__
+buildtools.__main__.load_command(sys.argv[1])
+print(time.perf_counter() - start)
+print(",".join(sorted(sys.modules)))
+"""
+
+
+def bench_startup(args: argparse.Namespace) -> None:
+    # import the package the same way `python -m buildtools` would
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(common.__file__)))
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_parent] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+
+    times: List[float] = []
+    modules: List[str] = []
+    for _ in range(args.repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT, args.command], env=env, text=True
+        )
+        seconds, imported = output.splitlines()[-2:]
+        times.append(float(seconds))
+        modules = imported.split(",")
+
+    best = min(times)
+    report(f"cold {args.command} import", best)
+    own = COMMANDS[args.command][0]
+    heavy = [m for m in STARTUP_HEAVY_MODULES if m in modules and m != own]
+    if heavy:
+        print(f"Heavy modules imported: {', '.join(heavy)}")
+
+    if best * 1000 > args.budget:
+        print(f"Import time over budget of {args.budget} ms")
+        sys.exit(1)
+
+
+def write_sample_files(directory: str, count: int, size: int) -> List[str]:
+    # compressible but not trivially so, like config files and text assets
+    rng = random.Random(0)
+    words = [
+        "".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(2, 10)))
+        for _ in range(2000)
+    ]
+    files: List[str] = []
+    for i in range(count):
+        text = " ".join(rng.choice(words) for _ in range(size // 6))
+        filename = os.path.join(directory, f"file{i}.cfg")
+        with open(filename, "w") as file:
+            file.write(text[:size])
+        files.append(filename)
+    return files
+
+
+def bench_package(args: argparse.Namespace) -> None:
+    import zipfile
+
+    from buildtools import archive
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = write_sample_files(directory, args.files, args.size)
+        entries = [(f, os.path.basename(f)) for f in files]
+        output = os.path.join(directory, "output.zip")
+
+        def serial() -> None:
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip:
+                for filename, arcname in entries:
+                    zip.write(filename, arcname)
+
+        def parallel(jobs: int) -> None:
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip:
+                archive.write_entries(zip, entries, jobs)
+
+        total = args.files * args.size / (1 << 20)
+        report(f"serial zip.write ({total:.0f} MiB)", measure(serial, args.repeat))
+        for jobs in args.jobs:
+            report(
+                f"parallel, {jobs} jobs ({total:.0f} MiB)",
+                measure(lambda: parallel(jobs), args.repeat),
+            )
+
+
+REPLACE_VARIABLES = {
+    "VersionMajor": 0,
+    "VersionMinor": 15,
+    "VersionBuild": 11,
+    "VersionRevision": 4,
+    "VersionName": "Mach",
+    "Year": 2020,
+    "NumericalVersion": (
+        "$(VersionMajor).$(VersionMinor).$(VersionBuild).$(VersionRevision)"
+    ),
+    "VersionString": '$(NumericalVersion) "$(VersionName)"',
+    "VersionRegex": r'\d+\.\d+\.\d+(?:\.\d+)?\s*"\w+"',
+}
+
+# the source file, Version.cs and README substitutions of config.json.example
+REPLACE_RULES = [
+    (r"([Cc]opyright )\d+", r"\g<1>$(Year)"),
+    (r"v$(VersionRegex)", r"v$(VersionString)"),
+    (r"Major = \d+;", r"Major = $(VersionMajor);"),
+    (r"Minor = \d+;", r"Minor = $(VersionMinor);"),
+    (r"Build = \d+;", r"Build = $(VersionBuild);"),
+    (r"Revision = \d+;", r"Revision = $(VersionRevision);"),
+    (r"-+master branch-+", r"$(NumericalVersion)"),
+]
+
+
+def write_sources(directory: str, count: int, lines: int) -> List[str]:
+    rng = random.Random(0)
+    files: List[str] = []
+    for i in range(count):
+        body = [
+            f"/* Copyright {rng.randint(2014, 2019)} v0.15.{rng.randint(0, 11)}.0 "
+            '"Mach" */',
+            f"namespace Ferram{i % 10} {{",
+        ]
+        for j in range(lines):
+            body.append(f"    public int Field{j} = {rng.randint(0, 1000)}; // {j}")
+        body.append("    public const int Major = 0; Minor = 15; Build = 0;")
+        body.append("}")
+        filename = os.path.join(directory, f"Source{i}.cs")
+        with open(filename, "w", newline="") as file:
+            file.write("\n".join(body))
+        files.append(filename)
+    return files
+
+
+def bench_replace(args: argparse.Namespace) -> None:
+    from buildtools.datatypes import Variables
+    from buildtools.substitutions import CompiledSubstitution, SubstitutionPlan
+
+    variables = Variables(common.resolve_variables(REPLACE_VARIABLES))
+    cache = common.ResolveCache()
+
+    def read(filename: str) -> str:
+        with open(filename, "r", newline="") as file:
+            return file.read()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = write_sources(directory, args.files, args.lines)
+
+        def per_file() -> List[str]:
+            # the previous implementation: resolve and re.sub every rule per file
+            results = []
+            for filename in files:
+                contents = read(filename)
+                for search, repl in REPLACE_RULES:
+                    pattern = cache.resolve(search, variables)
+                    replacement = cache.resolve(repl, variables)
+                    contents = re.sub(pattern, replacement, contents)
+                results.append(contents)
+            return results
+
+        def planned(prefilter: bool = True) -> List[str]:
+            rules = [
+                CompiledSubstitution(
+                    cache.resolve(search, variables), cache.resolve(repl, variables)
+                )
+                for search, repl in REPLACE_RULES
+            ]
+            if not prefilter:
+                for rule in rules:
+                    rule.literal = None
+            plan = SubstitutionPlan(rules)
+            return [plan.apply(read(filename))[0] for filename in files]
+
+        assert per_file() == planned() == planned(False)
+        name = f"{args.files} files"
+        report(f"per file re.sub ({name})", measure(per_file, args.repeat))
+        report(
+            f"compiled plan, no prefilter ({name})",
+            measure(lambda: planned(False), args.repeat),
+        )
+        report(f"compiled plan ({name})", measure(planned, args.repeat))
+
+
+def build_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-r", "--repeat", help="Number of repetitions", type=int, default=5
+    )
+    subparsers = parser.add_subparsers(description="Available benchmarks")
+
+    variables = subparsers.add_parser(
+        "variables", description="Variable resolution on a deep variable chain"
+    )
+    variables.add_argument("--depth", type=int, default=200)
+    variables.add_argument(
+        "--rescan-limit",
+        help="Maximum depth to run the rescanning implementation for",
+        type=int,
+        default=500,
+    )
+    variables.set_defaults(run=bench_variables)
+
+    startup = subparsers.add_parser(
+        "startup",
+        description="Cold import time of a subcommand, fails if it is over budget",
+    )
+    startup.add_argument("--command", choices=list(COMMANDS), default="postbuild")
+    startup.add_argument(
+        "--budget", help="Import time budget in ms", type=float, default=100
+    )
+    startup.set_defaults(run=bench_startup)
+
+    package = subparsers.add_parser(
+        "package", description="Serial and parallel zip compression"
+    )
+    package.add_argument("--files", type=int, default=200)
+    package.add_argument("--size", help="File size in bytes", type=int, default=256000)
+    package.add_argument(
+        "--jobs",
+        help="Job counts to run the parallel writer with",
+        type=int,
+        nargs="+",
+        default=[2, 4, os.cpu_count() or 1],
+    )
+    package.set_defaults(run=bench_package)
+
+    replace = subparsers.add_parser(
+        "replace", description="Regex substitutions over a synthetic C# source tree"
+    )
+    replace.add_argument("--files", type=int, default=3000)
+    replace.add_argument("--lines", help="Lines per file", type=int, default=200)
+    replace.set_defaults(run=bench_replace)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="buildtools benchmarks")
+    build_parser(parser)
+
+    args = parser.parse_args()
+    if hasattr(args, "run"):
+        args.run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,38 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
 import copy
+import functools
+import hashlib
+import json
 import logging
 import os
 import pathlib
 import subprocess
 import sys
-from typing import Dict, List, Optional
-from buildtools import common
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+from buildtools import common, sync, timings
 from buildtools.datatypes import BurstCompileAction, BurstTarget, PathLike, Config
 
 logger = logging.getLogger(__name__)
 
 
 def run(config: Config, args: argparse.Namespace):
-    burst_compile_all(config, args.print_help)
+    burst_compile_all(
+        config, args.print_help, common.jobs_count(args.jobs), args.force
+    )
 
 
 def build_parser(parser: argparse.ArgumentParser):
@@ -29,6 +46,14 @@ def build_parser(parser: argparse.ArgumentParser):
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--force",
+        help="Compile all targets even if they are up to date",
+        action="store_true",
+        default=False,
+    )
+    common.add_jobs_option(parser)
+    common.add_verbose_option(parser)
 
 
 def get_targets(config: BurstCompileAction):
@@ -76,7 +101,8 @@ def add_option(
     if option is None:
         return
 
-    option = common.resolve(option, config)
+    if isinstance(option, str):
+        option = common.resolve(option, config)
 
     if option:
         args.append(f"--{name.replace('_', '-')}")
@@ -97,71 +123,349 @@ def add_value_option(
 
     if is_path:
         option = common.resolve_path(option, config)
-    else:
+    elif isinstance(option, str):
         option = common.resolve(option, config)
 
     args.append(f"--{name.replace('_', '-')}={option}")
 
 
-def add_path_list_option(
-    args: List[str], target: BurstTarget, name: str, option_name: str, config: Config
-) -> None:
+class ArgumentCache(object):
+    """Argument fragments and glob expansions shared by the targets of one run
+
+    Targets that include another inherit its options so most fragments are only
+    built once for the parent.
+    """
+
+    def __init__(self) -> None:
+        self.fragments: Dict[Tuple[str, Hashable], List[str]] = {}
+        self.globs: Dict[str, List[pathlib.Path]] = {}
+        self.folders: Dict[str, List[pathlib.Path]] = {}
+
+    def fragment(
+        self, target: BurstTarget, name: str, build: Callable[[List[str]], None]
+    ) -> List[str]:
+        value = getattr(target, name, None)
+        if isinstance(value, list):
+            value = tuple(str(v) for v in value)
+        key = (name, value)
+        try:
+            return self.fragments[key]
+        except KeyError:
+            pass
+
+        args: List[str] = []
+        build(args)
+        self.fragments[key] = args
+        return args
+
+    def glob(self, path: pathlib.Path, config: Config) -> List[pathlib.Path]:
+        key = str(path)
+        try:
+            return self.globs[key]
+        except KeyError:
+            paths = self.globs[key] = list(config.glob(path))
+            return paths
+
+    def files(self, folder: pathlib.Path, config: Config) -> List[pathlib.Path]:
+        key = str(folder)
+        try:
+            return self.folders[key]
+        except KeyError:
+            pass
+
+        entries = config.fs.listdir(folder)
+        if entries is None:
+            files = [folder]
+        else:
+            files = [folder / name for name, e in entries.items() if e.is_file()]
+        self.folders[key] = files
+        return files
+
+
+def expand_paths(
+    target: BurstTarget,
+    name: str,
+    config: Config,
+    cache: Optional[ArgumentCache] = None,
+) -> List[pathlib.Path]:
     paths: Optional[List[pathlib.Path]] = getattr(target, name, None)
     if paths is None:
-        return
+        return []
 
+    expanded: List[pathlib.Path] = []
     path: pathlib.Path
     for path in paths:
         path = common.resolve_path(path, config)
-        if "*" in str(path):
-            for p in config.glob(path):
-                args.append(f"--{option_name}={p}")
+        if "*" not in str(path):
+            expanded.append(path)
+        elif cache is not None:
+            expanded.extend(cache.glob(path, config))
         else:
-            args.append(f"--{option_name}={path}")
+            expanded.extend(config.glob(path))
+    return expanded
 
 
-def burst_compile(
-    bcl: PathLike, target: BurstTarget, config: Config, debug: bool = False
+def add_path_list_option(
+    args: List[str],
+    target: BurstTarget,
+    name: str,
+    option_name: str,
+    config: Config,
+    cache: Optional[ArgumentCache] = None,
 ) -> None:
+    for path in expand_paths(target, name, config, cache):
+        args.append(f"--{option_name}={path}")
+
+
+def add_target_list(
+    args: List[str], target: BurstTarget, name: str, config: Config
+) -> None:
+    for t in getattr(target, name, None) or []:
+        args.append(f"--target={common.resolve(t, config)}")
+
+
+def target_inputs(
+    target: BurstTarget, config: Config, cache: Optional[ArgumentCache] = None
+) -> List[pathlib.Path]:
+    """Root assemblies and everything in the assembly folders"""
+    if cache is None:
+        cache = ArgumentCache()
+    inputs = expand_paths(target, "root_assemblies", config, cache)
+    for folder in expand_paths(target, "assembly_folders", config, cache):
+        inputs.extend(cache.files(folder, config))
+    return sorted(set(inputs))
+
+
+# bcl appends a platform specific extension to the output name
+OUTPUT_EXTENSIONS = (".dll", ".so", ".dylib", ".bundle", ".a")
+
+
+class BurstCache(object):
+    """Cache key of the last successful compile, stored next to the target output"""
+
+    def __init__(self, output: pathlib.Path):
+        self.output = output
+        self.filename = output.with_name(output.name + ".burstcache")
+        self.key: Optional[str] = None
+        # path -> [size, mtime_ns, sha1] so that unchanged inputs aren't hashed again
+        self.digests: Dict[str, List[Any]] = {}
+        self.used: Dict[str, List[Any]] = {}
+
+        try:
+            with open(self.filename, "r") as file:
+                data = json.load(file)
+            self.key = data["key"]
+            self.digests = data["digests"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def digest(self, path: PathLike) -> str:
+        key = str(path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return "missing"
+
+        entry = self.digests.get(key)
+        if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+            entry = [st.st_size, st.st_mtime_ns, sync.file_digest(path)]
+        self.used[key] = entry
+        return entry[2]
+
+    def key_for(
+        self, args: List[str], bcl: PathLike, inputs: Iterable[PathLike], debug: bool
+    ) -> str:
+        digest = hashlib.sha1()
+        for part in [*args, f"debug={debug}", self.digest(bcl)]:
+            digest.update(part.encode("utf-8") + b"\0")
+        for path in inputs:
+            digest.update(f"{path}\0{self.digest(path)}\0".encode("utf-8"))
+        return digest.hexdigest()
+
+    def output_exists(self) -> bool:
+        try:
+            names = os.listdir(self.output.parent)
+        except OSError:
+            return False
+        # the cache and timing history share the prefix but aren't outputs
+        return any(
+            name.startswith(self.output.name) and name.endswith(OUTPUT_EXTENSIONS)
+            for name in names
+        )
+
+    def is_current(self, key: str) -> bool:
+        return key == self.key and self.output_exists()
+
+    def save(self, key: str) -> None:
+        self.key = key
+        try:
+            with open(self.filename, "w") as file:
+                json.dump({"key": key, "digests": self.used}, file)
+        except OSError:
+            logger.warning("Failed to write burst cache %s", self.filename)
+
+
+# bcl options in command line order
+OPTIONS: List[Tuple[str, Callable[..., None]]] = [
+    ("platform", add_value_option),
+    (
+        "safety_checks",
+        functools.partial(add_option, if_false="--disable-safety-checks"),
+    ),
+    ("fast_math", add_option),
+    ("enable_guard", add_option),
+    ("float_precision", add_value_option),
+    ("float_mode", add_value_option),
+    ("debug", add_value_option),
+    ("debug_mode", add_option),
+    ("output", functools.partial(add_value_option, is_path=True)),
+    ("verbose", add_option),
+    ("log_timings", add_option),
+    ("key_folder", functools.partial(add_value_option, is_path=True)),
+    ("include_root_assembly_references", add_value_option),
+    ("targets", add_target_list),
+    (
+        "root_assemblies",
+        functools.partial(add_path_list_option, option_name="root-assembly"),
+    ),
+    (
+        "assembly_folders",
+        functools.partial(add_path_list_option, option_name="assembly-folder"),
+    ),
+]
+
+
+def burst_args(
+    bcl: PathLike,
+    target: BurstTarget,
+    config: Config,
+    cache: Optional[ArgumentCache] = None,
+) -> List[str]:
+    if cache is None:
+        cache = ArgumentCache()
+
     args: List[str] = [str(bcl)]
+    for name, add in OPTIONS:
+        kwargs: Dict[str, Any] = {"config": config}
+        if name in ("root_assemblies", "assembly_folders"):
+            kwargs["cache"] = cache
+        args.extend(
+            cache.fragment(
+                target, name, lambda fragment: add(fragment, target, name, **kwargs)
+            )
+        )
+    return args
 
-    add_value_option(args, target, "platform", config)
-    add_option(args, target, "safety_checks", config, "--disable-safety-checks")
-    add_option(args, target, "fast_math", config)
-    add_option(args, target, "enable_guard", config)
-    add_value_option(args, target, "float_precision", config)
-    add_value_option(args, target, "float_mode", config)
-    add_value_option(args, target, "debug", config)
-    add_option(args, target, "debug_mode", config)
-    add_value_option(args, target, "output", config, is_path=True)
-    add_option(args, target, "verbose", config)
-    add_option(args, target, "log_timings", config)
-    add_value_option(args, target, "key_folder", config, is_path=True)
-    add_value_option(args, target, "include_root_assembly_references", config)
-
-    if target.targets:
-        for t in target.targets:
-            args.append(f"--target={common.resolve(t, config)}")
-
-    add_path_list_option(args, target, "root_assemblies", "root-assembly", config)
-    add_path_list_option(args, target, "assembly_folders", "assembly-folder", config)
 
-    logger.debug("Running burst with args: %s", args)
+def burst_env(debug: bool = False) -> Mapping[str, str]:
+    if not debug:
+        return os.environ
+    env = os.environ.copy()
+    env["UNITY_BURST_DEBUG"] = ""
+    return env
 
-    if debug:
-        env = os.environ.copy()
-        env["UNITY_BURST_DEBUG"] = ""
-    else:
-        env = os.environ  # type: ignore
+
+def burst_compile(
+    bcl: PathLike, target: BurstTarget, config: Config, debug: bool = False
+) -> None:
+    args = burst_args(bcl, target, config)
+    logger.debug("Running burst with args: %s", args)
 
     try:
-        subprocess.check_call(args, env=env)
+        subprocess.check_call(args, env=burst_env(debug))
     except Exception:
         logger.exception("Burst compile failed. Command line: %s", args)
         raise
 
 
-def burst_compile_all(config: Config, print_help: bool = False) -> None:
+class BurstRun(object):
+    """Outcome of compiling a single target"""
+
+    def __init__(self, platform: str, args: List[str], cache: BurstCache, key: str):
+        self.platform = platform
+        self.args = args
+        self.cache = cache
+        self.key = key
+        self.returncode: Optional[int] = None
+        self.seconds = 0.0
+        self.stdout = ""
+        self.stderr = ""
+        self.error: Optional[BaseException] = None
+
+    @property
+    def log_timings(self) -> bool:
+        return "--log-timings" in self.args
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None and self.returncode == 0
+
+
+def run_target(run: BurstRun, env: Mapping[str, str], capture: bool) -> BurstRun:
+    logger.debug("Running burst with args: %s", run.args)
+    # timings are parsed from the output so it has to be captured
+    capture = capture or run.log_timings
+    start = time.perf_counter()
+    try:
+        # concurrent targets are buffered so that their output doesn't interleave
+        process = subprocess.run(
+            run.args,
+            env=env,
+            capture_output=capture,
+            text=capture,
+            errors="replace" if capture else None,
+        )
+    except Exception as e:
+        run.error = e
+    else:
+        run.returncode = process.returncode
+        if capture:
+            run.stdout = process.stdout
+            run.stderr = process.stderr
+    run.seconds = time.perf_counter() - start
+    return run
+
+
+def report_target(run: BurstRun) -> None:
+    if run.stdout:
+        sys.stdout.write(run.stdout)
+    if run.stderr:
+        sys.stderr.write(run.stderr)
+
+    if run.error is not None:
+        logger.error(
+            "Exception compiling target '%s'",
+            run.platform,
+            exc_info=(type(run.error), run.error, run.error.__traceback__),
+        )
+    elif run.returncode != 0:
+        logger.error("Burst compile failed. Command line: %s", run.args)
+    if run.succeeded:
+        run.cache.save(run.key)
+    status = "ok" if run.succeeded else f"failed (exit code {run.returncode})"
+    print(f"Burst target '{run.platform}': {status} in {run.seconds:.2f}s")
+    if run.log_timings and run.succeeded:
+        record_timings(run)
+    sys.stdout.flush()
+
+
+def record_timings(run: BurstRun) -> None:
+    current = timings.parse(run.stdout + run.stderr)
+    if not current:
+        logger.warning("No timings found in the output of target '%s'", run.platform)
+        return
+
+    output = run.cache.output
+    history = timings.TimingHistory(output.with_name(output.name + ".timings.json"))
+    previous = history.latest()
+    history.append(current)
+    history.save()
+    timings.report(run.platform, current, previous)
+
+
+def burst_compile_all(
+    config: Config, print_help: bool = False, jobs: int = 1, force: bool = False
+) -> None:
     compile_config = config.burst_compile
     bcl = compile_config.bcl
     bcl = common.resolve_path(bcl, config)
@@ -170,14 +474,40 @@ def burst_compile_all(config: Config, print_help: bool = False) -> None:
         subprocess.call([bcl, "--help"])
         sys.exit(0)
 
-    debug = compile_config.debug
-
+    env = burst_env(compile_config.debug)
+    runs: List[BurstRun] = []
+    skipped: List[str] = []
+    arguments = ArgumentCache()
     targets = get_targets(compile_config)
     for platform, target in targets.items():
         try:
-            burst_compile(bcl, target, config, debug)
+            args = burst_args(bcl, target, config, arguments)
+            cache = BurstCache(common.resolve_path(target.output, config))
+            inputs = target_inputs(target, config, arguments)
+            key = cache.key_for(args, bcl, inputs, compile_config.debug)
         except Exception:
             logger.exception("Exception compiling target '%s'", platform)
+            continue
+
+        if not force and cache.is_current(key):
+            print(f"Burst target '{platform}': up to date")
+            skipped.append(platform)
+            continue
+        runs.append(BurstRun(platform, args, cache, key))
+
+    # failed targets are logged and the rest still compile
+    start = time.perf_counter()
+    capture = jobs > 1 and len(runs) > 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(run_target, run, env, capture) for run in runs]
+        for future in concurrent.futures.as_completed(futures):
+            report_target(future.result())
+
+    succeeded = sum(run.succeeded for run in runs)
+    print(
+        f"Burst compiled {succeeded}/{len(runs)} targets, {len(skipped)} up to date "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
 
 
 def main():
@@ -187,11 +517,14 @@ def main():
 
     args = parser.parse_args()
 
-    config = common.load_config(args.config)
+    config = common.load_config(args.config, args.config_cache)
 
     with common.chdir(config.root):
         run(config, args)
 
+    if args.verbose > 0:
+        common.print_stats()
+
 
 if __name__ == "__main__":
     main()
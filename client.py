@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+# Thin client for the build server, keep the imports to a minimum since startup time
+# is the whole point. Usage is the same as `python -m buildtools`:
+#   python -m buildtools.client postbuild -c Debug -t path/to/target.dll
+
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import socket
+import sys
+from typing import List, Optional
+
+# exit code reported by the server when it can't handle the request
+UNAVAILABLE = "unavailable"
+
+
+def runtime_dir() -> str:
+    # per user so that nobody else can put a server in front of ours
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base:
+        return os.path.join(base, "buildtools")
+
+    from buildtools.common import user_cache_dir
+
+    return os.path.join(user_cache_dir(), "run")
+
+
+def socket_path(config_file: str) -> str:
+    digest = hashlib.sha1(os.path.normcase(config_file).encode("utf-8")).hexdigest()
+    return os.path.join(runtime_dir(), f"{digest[:16]}.sock")
+
+
+def owned_by_user(path: str) -> bool:
+    if not hasattr(os, "getuid"):
+        return True
+    return os.stat(path).st_uid == os.getuid()
+
+
+def config_file(argv: List[str], cwd: str) -> str:
+    # same default and flags as common.add_config_option
+    name = "config.json"
+    for i, arg in enumerate(argv):
+        if arg in ("-f", "--file") and i + 1 < len(argv):
+            name = argv[i + 1]
+        elif arg.startswith("--file="):
+            name = arg[len("--file=") :]
+        elif arg.startswith("-f") and len(arg) > 2:
+            name = arg[2:]
+    return os.path.abspath(os.path.join(cwd, name))
+
+
+def request(argv: List[str], cwd: Optional[str] = None) -> Optional[int]:
+    # returns None if the request has to be executed in process
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    if cwd is None:
+        cwd = os.getcwd()
+
+    path = socket_path(config_file(argv, cwd))
+    try:
+        if not owned_by_user(path):
+            print(f"Ignoring build server {path} of another user", file=sys.stderr)
+            return None
+    except OSError:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile("rwb") as stream:
+        message = {"argv": argv, "cwd": cwd}
+        stream.write(json.dumps(message).encode("utf-8") + b"\n")
+        stream.flush()
+
+        for line in stream:
+            reply = json.loads(line)
+            if "stdout" in reply:
+                sys.stdout.write(reply["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in reply:
+                sys.stderr.write(reply["stderr"])
+                sys.stderr.flush()
+            elif "exit" in reply:
+                if reply["exit"] == UNAVAILABLE:
+                    return None
+                return int(reply["exit"])
+
+    print("Build server closed the connection unexpectedly", file=sys.stderr)
+    return 1
+
+
+def main(argv: Optional[List[str]] = None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    code = request(argv)
+    if code is None:
+        from buildtools.__main__ import main as run_in_process
+
+        run_in_process(argv)
+        code = 0
+
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,19 +23,38 @@ from __future__ import annotations
 import argparse
 
 import contextlib
+import hashlib
 import logging
 import json
 import os
+import pickle
 import re
-import xml.etree.ElementTree as ET
-from typing import Any, Dict, Mapping, Optional, TypeVar
+import sys
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Counter,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 import pathlib
 from buildtools.datatypes import PathLike, Config
+from buildtools.stats import counters
 
 VAR_PATTERN = re.compile(r"\$\(([\w\_\-\:\d]+)\)")
 SILENT_VARS = {
     "Configuration",
 }
+# don't keep whole file contents around in the resolution cache
+MAX_CACHED_LENGTH = 4096
+# bump whenever the cached config layout changes
+CONFIG_CACHE_VERSION = 3
 
 K = TypeVar("K")
 V = TypeVar("V")
@@ -52,12 +71,135 @@ def recursive_update(left: Dict[K, V], right: Dict[K, V]) -> None:
             left[k] = v
 
 
-def load_config(filename: PathLike) -> Config:
+FileSignature = Optional[Tuple[int, int]]
+
+
+def file_signature(filename: PathLike) -> FileSignature:
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+@dataclass
+class ConfigSnapshot:
+    config: Config
+    # every file the config was read from, including missing optional files
+    inputs: Dict[str, FileSignature] = field(default_factory=dict)
+    solution_files: Dict[str, List[str]] = field(default_factory=dict)
+    environment: Dict[str, Optional[str]] = field(default_factory=dict)
+    version: int = CONFIG_CACHE_VERSION
+
+    def is_valid(self) -> bool:
+        if self.version != CONFIG_CACHE_VERSION:
+            return False
+
+        for filename, signature in self.inputs.items():
+            if file_signature(filename) != signature:
+                return False
+
+        for dirname, names in self.solution_files.items():
+            if find_solution_files(dirname) != names:
+                return False
+
+        for name, value in self.environment.items():
+            if os.environ.get(name, None) != value:
+                return False
+
+        return True
+
+
+def user_cache_dir() -> pathlib.Path:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or pathlib.Path.home() / "AppData/Local"
+    elif sys.platform == "darwin":
+        base = pathlib.Path.home() / "Library/Caches"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(base) / "buildtools"
+
+
+def config_cache_path(filename: PathLike) -> pathlib.Path:
+    """Snapshot file of the config, keyed by its absolute path
+
+    Snapshots are unpickled so they are kept in the per-user cache directory. A file
+    next to the config could be committed to a checkout and run code when loaded.
+    """
+    key = os.path.normcase(os.path.abspath(filename))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return user_cache_dir() / "config" / f"{digest}.pickle"
+
+
+def owned_by_user(fd: int) -> bool:
+    if not hasattr(os, "geteuid"):
+        return True
+    return os.fstat(fd).st_uid == os.geteuid()
+
+
+def read_config_cache(filename: PathLike) -> Optional[ConfigSnapshot]:
+    try:
+        with open(filename, "rb") as file:
+            if not owned_by_user(file.fileno()):
+                logger.warning("Ignoring config cache %s of another user", filename)
+                return None
+            snapshot = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # stale caches from other versions may not even unpickle
+        logger.debug("Failed to read config cache %s", filename, exc_info=True)
+        return None
+
+    if not isinstance(snapshot, ConfigSnapshot):
+        return None
+    return snapshot
+
+
+def write_config_cache(filename: PathLike, snapshot: ConfigSnapshot) -> None:
+    filename = pathlib.Path(filename)
+    tmp = filename.with_name(f"{filename.name}.{os.getpid()}.tmp")
+    try:
+        filename.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with open(tmp, "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except OSError:
+        logger.debug("Failed to write config cache %s", filename, exc_info=True)
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+
+
+def load_config(filename: PathLike, use_cache: bool = True) -> Config:
+    return load_config_snapshot(filename, use_cache).config
+
+
+def load_config_snapshot(
+    filename: PathLike, use_cache: bool = True
+) -> ConfigSnapshot:
     filename = pathlib.Path(filename).absolute()
+    cache_file = config_cache_path(filename)
+
+    if use_cache:
+        snapshot = read_config_cache(cache_file)
+        if snapshot is not None and snapshot.is_valid():
+            return snapshot
+
+    snapshot = parse_config(filename)
+    if use_cache:
+        write_config_cache(cache_file, snapshot)
+    return snapshot
+
+
+def parse_config(filename: pathlib.Path) -> ConfigSnapshot:
+    inputs: List[pathlib.Path] = [filename]
+    environment: Dict[str, Optional[str]] = {}
+
     with open(filename) as file:
         data: Dict[str, Any] = json.load(file)
 
     user_file = filename.with_suffix(filename.suffix + ".user")
+    inputs.append(user_file)
     if user_file.exists():
         with open(user_file) as file:
             user_data = json.load(file)
@@ -77,16 +219,18 @@ def load_config(filename: PathLike) -> Config:
         data["build_props"] = root / data["build_props"]
 
     data.setdefault("variables", {}).update(
-        load_variables(root, data.get("build_props", None))
+        load_variables(root, data.get("build_props", None), inputs, environment)
     )
 
-    for name, value in data["variables"].items():
-        if not isinstance(value, str):
-            continue
-
-        data["variables"][name] = replace_variables(value, data["variables"])
+    data["variables"] = resolve_variables(data["variables"], environment)
 
-    return Config(**data)
+    sol_dir = find_solution_dir(root)
+    return ConfigSnapshot(
+        config=Config(**data),
+        inputs={str(f): file_signature(f) for f in inputs},
+        solution_files={str(sol_dir): find_solution_files(sol_dir)},
+        environment=environment,
+    )
 
 
 def find_solution_dir(root: Optional[PathLike] = None) -> pathlib.Path:
@@ -110,16 +254,26 @@ def get_solution_vars(
 ) -> Dict[str, str]:
     sol_dir = find_solution_dir(root)
     data: Dict[str, str] = {"SolutionDir": str(sol_dir)}
-    sol_files = list(sol_dir.glob("*.sln"))
+    sol_files = find_solution_files(sol_dir)
     if sol_files:
-        sol_file = sol_files[0]
+        sol_file = pathlib.Path(sol_files[0])
         data["SolutionFileName"] = sol_file.name
         data["SolutionName"] = sol_file.stem
     return data
 
 
-def load_build_props(filename: PathLike) -> Dict[str, str]:
+def find_solution_files(dirname: PathLike) -> List[str]:
+    return [p.name for p in pathlib.Path(dirname).glob("*.sln")]
+
+
+def load_build_props(
+    filename: PathLike, imports: Optional[List[pathlib.Path]] = None
+) -> Dict[str, str]:
+    import xml.etree.ElementTree as ET
+
     filename = pathlib.Path(filename)
+    if imports is not None:
+        imports.append(filename)
     tree = ET.parse(filename)
     root = tree.getroot()
     data: Dict[str, str] = {}
@@ -130,7 +284,9 @@ def load_build_props(filename: PathLike) -> Dict[str, str]:
             if not project.is_absolute():
                 project = filename.parent / project
             if project.exists():
-                data.update(load_build_props(project))
+                data.update(load_build_props(project, imports))
+            elif imports is not None:
+                imports.append(project)
         elif section.tag == "PropertyGroup":
             for item in section:
                 if item.text is None:
@@ -141,44 +297,211 @@ def load_build_props(filename: PathLike) -> Dict[str, str]:
 
 
 def load_variables(
-    root: Optional[PathLike] = None, filename: Optional[PathLike] = None
+    root: Optional[PathLike] = None,
+    filename: Optional[PathLike] = None,
+    imports: Optional[List[pathlib.Path]] = None,
+    environment: Optional[Dict[str, Optional[str]]] = None,
 ) -> Dict[str, str]:
     data = get_solution_vars(root)
     if filename is not None:
-        data.update(load_build_props(filename))
-    for key, value in data.items():
-        data[key] = replace_variables(value, data)
-    return data
+        data.update(load_build_props(filename, imports))
+    return resolve_variables(data, environment)
 
 
-def replace_variables(string: str, var_map: Mapping[str, Any]) -> str:
-    def _re_sub(matchobj: re.Match[str]):
-        identifier = matchobj.group(1)
+class VariableCycleError(ValueError):
+    def __init__(self, chain: List[str]):
+        self.chain = chain
+        super().__init__(
+            "Cyclic variable reference: " + " -> ".join(f"$({v})" for v in chain)
+        )
+
+
+class VariableResolver(object):
+    """Expands $(...) references by walking the variable dependency graph
+
+    Every variable is expanded exactly once, after all the variables it references,
+    so any string only needs a single substitution pass over memoized values.
+    """
+
+    def __init__(
+        self,
+        variables: Mapping[str, Any],
+        environment: Optional[Dict[str, Optional[str]]] = None,
+    ):
+        self.variables = variables
+        self.resolved: Dict[str, Any] = {}
+        # records environment variables that were used, if provided
+        self.environment = environment
+
+    def dependencies(self, name: str) -> Iterator[str]:
+        value = self.variables[name]
+        if not isinstance(value, str):
+            return
+
+        for identifier in VAR_PATTERN.findall(value):
+            if not identifier.startswith("env:") and identifier in self.variables:
+                yield identifier
+
+    def get(self, name: str) -> Any:
+        try:
+            return self.resolved[name]
+        except KeyError:
+            pass
+
+        # iterative depth first search so that deep chains don't hit recursion limit
+        stack: List[Tuple[str, Iterator[str]]] = [(name, self.dependencies(name))]
+        path: List[str] = [name]
+        visiting: Set[str] = {name}
+        while stack:
+            current, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency in self.resolved:
+                    continue
+                if dependency in visiting:
+                    raise VariableCycleError(
+                        path[path.index(dependency) :] + [dependency]
+                    )
+                visiting.add(dependency)
+                path.append(dependency)
+                stack.append((dependency, self.dependencies(dependency)))
+                break
+            else:
+                stack.pop()
+                path.pop()
+                visiting.discard(current)
+                value = self.variables[current]
+                if isinstance(value, str):
+                    value = self.expand(value)
+                self.resolved[current] = value
+
+        return self.resolved[name]
+
+    def lookup(self, identifier: str) -> Optional[str]:
         value: Any = None
         if identifier.startswith("env:"):
             value = os.environ.get(identifier[4:], None)
-        else:
-            value = var_map.get(identifier, None)
+            if self.environment is not None:
+                self.environment[identifier[4:]] = value
+        elif identifier in self.variables:
+            value = self.get(identifier)
 
         if value is None:
-            if identifier not in SILENT_VARS:
-                logger.warn("Variable %s not found!", identifier)
-            return ""
-
+            return None
         return str(value)
 
-    newstr, subs = re.subn(VAR_PATTERN, _re_sub, string)
-    while subs > 0:
-        newstr, subs = re.subn(VAR_PATTERN, _re_sub, newstr)
-    return newstr
+    def expand(self, string: str) -> str:
+        def _re_sub(matchobj: re.Match[str]):
+            identifier = matchobj.group(1)
+            value = self.lookup(identifier)
+
+            if value is None:
+                if identifier not in SILENT_VARS:
+                    logger.warning("Variable %s not found!", identifier)
+                return ""
+
+            return value
+
+        return VAR_PATTERN.sub(_re_sub, string)
+
+
+def resolve_variables(
+    variables: Mapping[str, Any],
+    environment: Optional[Dict[str, Optional[str]]] = None,
+) -> Dict[str, Any]:
+    resolver = VariableResolver(variables, environment)
+    return {name: resolver.get(name) for name in variables}
+
+
+def replace_variables(string: str, var_map: Mapping[str, Any]) -> str:
+    return VariableResolver(var_map).expand(string)
+
+
+class ResolveCache(object):
+    def __init__(self):
+        self.variables: Optional[Mapping[str, Any]] = None
+        self.version: Optional[int] = None
+        self.resolver: Optional[VariableResolver] = None
+        self.strings: Dict[str, str] = {}
+        self.paths: Dict[str, pathlib.Path] = {}
+
+    def validate(self, variables: Mapping[str, Any]) -> VariableResolver:
+        # plain mappings have no version counter so they are never cached
+        version: Optional[int] = getattr(variables, "version", None)
+        if (
+            self.resolver is None
+            or variables is not self.variables
+            or version is None
+            or version != self.version
+        ):
+            if self.strings or self.paths:
+                counters["resolve invalidations"] += 1
+            self.strings.clear()
+            self.paths.clear()
+            self.variables = variables
+            self.version = version
+            self.resolver = VariableResolver(variables)
+        return self.resolver
+
+    def resolve(self, string: str, variables: Mapping[str, Any]) -> str:
+        resolver = self.validate(variables)
+        try:
+            value = self.strings[string]
+            counters["resolve hits"] += 1
+            return value
+        except KeyError:
+            counters["resolve misses"] += 1
+
+        value = resolver.expand(string)
+        if self.version is not None and len(string) <= MAX_CACHED_LENGTH:
+            self.strings[string] = value
+        return value
+
+    def resolve_path(
+        self, string: PathLike, variables: Mapping[str, Any]
+    ) -> pathlib.Path:
+        string = str(string)
+        self.validate(variables)
+        try:
+            path = self.paths[string]
+            counters["resolve hits"] += 1
+            return path
+        except KeyError:
+            pass
+
+        path = pathlib.Path(self.resolve(string, variables))
+        if self.version is not None:
+            self.paths[string] = path
+        return path
+
+
+def resolve_cache(config: Config) -> ResolveCache:
+    cache: Optional[ResolveCache] = getattr(config, "_resolve_cache", None)
+    if cache is None:
+        cache = ResolveCache()
+        setattr(config, "_resolve_cache", cache)
+    return cache
 
 
 def resolve(string: str, config: Config) -> str:
-    return replace_variables(string, config.variables)
+    return resolve_cache(config).resolve(string, config.variables)
 
 
 def resolve_path(string: PathLike, config: Config) -> pathlib.Path:
-    return pathlib.Path(resolve(str(string), config))
+    return resolve_cache(config).resolve_path(string, config.variables)
+
+
+def print_stats(stats: Optional[Counter[str]] = None) -> None:
+    if stats is None:
+        stats = counters
+    print(
+        f"Variable resolution: {stats['resolve hits']} cache hits, "
+        f"{stats['resolve misses']} misses, "
+        f"{stats['resolve invalidations']} invalidations"
+    )
+    print(
+        f"Filesystem: {stats['fs reads']} directory reads and {stats['fs stats']} "
+        f"stat calls for {stats['fs lookups']} lookups"
+    )
 
 
 @contextlib.contextmanager
@@ -199,6 +522,35 @@ def add_config_option(parser: argparse.ArgumentParser):
         dest="config",
         default="config.json",
     )
+    parser.add_argument(
+        "--no-config-cache",
+        help="Always parse the configuration instead of using the cached snapshot",
+        dest="config_cache",
+        action="store_false",
+        default=True,
+    )
+
+
+def add_verbose_option(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-v", "--verbose", action="count", help="Increase output verbosity", default=0
+    )
+
+
+def add_jobs_option(parser: argparse.ArgumentParser, default: int = 1):
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of parallel jobs, 0 to use all CPUs",
+        type=int,
+        default=default,
+    )
+
+
+def jobs_count(jobs: int) -> int:
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
 
 
 def main():
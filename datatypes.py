@@ -7,7 +7,7 @@ from dataclasses import Field, dataclass, field, fields
 import dataclasses
 from functools import reduce
 import json
-
+import os
 import pathlib
 import sys
 from typing import (
@@ -15,7 +15,9 @@ from typing import (
     Callable,
     Dict,
     Generator,
+    Iterable,
     List,
+    Mapping,
     MutableSequence,
     Optional,
     Type,
@@ -23,7 +25,8 @@ from typing import (
     Union,
     cast,
 )
-import zipfile
+
+from buildtools.fsindex import FileSystemIndex, PathMatcher
 
 PathLike = Union[str, pathlib.Path]
 
@@ -192,40 +195,58 @@ class PostBuildActionList:
 @dataclass
 class PostBuildAction(PostBuildActionList):
     pdb2mdb: Optional[pathlib.Path] = None
+    # one of sync.LINK_STRATEGIES
+    link: str = "copy"
 
     def __init__(
         self,
         clean: List[str] = dataclasses.MISSING,  # type: ignore
         install: List[FileCopy] = dataclasses.MISSING,  # type: ignore
         pdb2mdb: Optional[PathLike] = None,
+        link: str = "copy",
         **kwargs: PostBuildActionList,
     ) -> None:
+        self.per_target = parse_dict(kwargs, PostBuildActionList)
+        self._add_target_fields()
         super().__init__(clean, install)
+        self.link = link
         self.pdb2mdb = None
         if pdb2mdb is not None:
             self.pdb2mdb = pathlib.Path(pdb2mdb)
-        self.per_target = parse_dict(kwargs, PostBuildActionList)
 
-        # emulate dynamic fields
-        fs: Dict[str, Field[Any]] = getattr(self, "__dataclass_fields__")
+        try:
+            self.__post_init__()  # type: ignore
+        except AttributeError:
+            pass
+
+    def _add_target_fields(self) -> None:
+        # emulate dynamic fields, per instance so that targets of one config don't
+        # leak into others
+        fs: Dict[str, Field[Any]] = dict(getattr(type(self), "__dataclass_fields__"))
         default_field = fs["pdb2mdb"]
         for name in self.per_target:
             f = copy.copy(default_field)
             f.name = name
             f.type = "PostBuildActionList"  # type: ignore
             fs[name] = f
+        setattr(self, "__dataclass_fields__", fs)
 
-        try:
-            self.__post_init__()  # type: ignore
-        except AttributeError:
-            pass
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        state.pop("__dataclass_fields__", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._add_target_fields()
 
     def __getitem__(self, key: str) -> PostBuildActionList:
         return self.per_target[key]
 
     def __getattr__(self, name: str) -> PostBuildActionList:
+        # per_target may not exist yet while unpickling
         try:
-            return self[name]
+            return self.__dict__["per_target"][name]
         except KeyError as e:
             raise AttributeError(name) from e
 
@@ -247,6 +268,28 @@ class Dependency:
     map: List[FileCopy] = listfield(FileCopy)
 
 
+def compression_value(compression: str) -> int:
+    if compression.upper() == "AUTO":
+        from buildtools.archive import AUTO
+
+        return AUTO
+
+    import zipfile
+
+    return getattr(zipfile, f"ZIP_{compression.upper()}")
+
+
+@dataclass
+class CompressionRule:
+    # matched against archive names the same way as Path.match
+    pattern: str
+    compression: str
+
+    @property
+    def compression_value(self) -> int:
+        return compression_value(self.compression)
+
+
 @dataclass
 @jsonclass
 class PackageAction:
@@ -257,12 +300,16 @@ class PackageAction:
     map: List[FileCopy] = listfield(FileCopy)
     dependencies: List[Dependency] = listfield(Dependency)
     compression: Optional[str] = "DEFLATED"
+    compression_rules: List[CompressionRule] = listfield(CompressionRule)
+    # one of sync.LINK_STRATEGIES, only used without compression
+    link: str = "copy"
 
     @property
     def compression_value(self) -> Optional[int]:
         if self.compression is None:
             return None
-        return getattr(zipfile, f"ZIP_{self.compression.upper()}")
+
+        return compression_value(self.compression)
 
 
 @dataclass
@@ -305,6 +352,48 @@ class BurstCompileAction:
     targets: List[BurstTarget] = listfield(BurstTarget)
 
 
+class Variables(Dict[str, Union[str, int]]):
+    # modification counter so that anything derived from variables can be invalidated
+    version: int = 0
+
+    def _modified(self) -> None:
+        self.version += 1
+
+    def __setitem__(self, key: str, value: Union[str, int]) -> None:
+        super().__setitem__(key, value)
+        self._modified()
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._modified()
+
+    def __ior__(self, other: Any) -> Variables:  # type: ignore
+        super().__ior__(other)
+        self._modified()
+        return self
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        super().update(*args, **kwargs)
+        self._modified()
+
+    def setdefault(self, key: str, default: Union[str, int]) -> Union[str, int]:
+        if key not in self:
+            self._modified()
+        return super().setdefault(key, default)
+
+    def pop(self, key: str, *args: Any) -> Any:
+        self._modified()
+        return super().pop(key, *args)
+
+    def popitem(self) -> Any:
+        self._modified()
+        return super().popitem()
+
+    def clear(self) -> None:
+        super().clear()
+        self._modified()
+
+
 @dataclass
 @jsonclass
 class Config:
@@ -314,12 +403,35 @@ class Config:
     replace: ReplaceAction
     package: PackageAction
     burst_compile: BurstCompileAction
-    variables: Dict[str, Union[str, int]] = field(default_factory=dict)
+    variables: Variables = field(
+        default_factory=Variables, metadata=dict(__post_init__=Variables)
+    )
 
     def __post_init__(self):
         if not self.build_props.is_absolute():
             self.build_props = self.root / self.build_props
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # underscored attributes are transient caches that shouldn't be copied
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def with_variables(self, variables: Mapping[str, Union[str, int]]) -> Config:
+        # shallow copy sharing everything but the variables
+        config = copy.copy(self)
+        config.variables = Variables(self.variables)
+        config.variables.update(variables)
+        # the filesystem doesn't depend on variables
+        setattr(config, "_fs_index", self.fs)
+        return config
+
+    @property
+    def fs(self) -> FileSystemIndex:
+        index: Optional[FileSystemIndex] = getattr(self, "_fs_index", None)
+        if index is None:
+            index = FileSystemIndex()
+            setattr(self, "_fs_index", index)
+        return index
+
     def glob(
         self, pattern: PathLike, root: Optional[PathLike] = None
     ) -> Generator[pathlib.Path, None, None]:
@@ -336,7 +448,23 @@ class Config:
         else:
             p = str(pattern)
 
-        return root.glob(p)
+        return self.fs.glob(root, p)
+
+    def matcher(
+        self,
+        includes: Iterable[PathLike],
+        excludes: Iterable[PathLike] = (),
+        root: Optional[PathLike] = None,
+    ) -> PathMatcher:
+        if root is None:
+            root = self.root
+
+        def absolute(pattern: PathLike) -> str:
+            return os.path.join(root, pathlib.Path(pattern).expanduser())
+
+        return PathMatcher(
+            [absolute(p) for p in includes], [absolute(p) for p in excludes]
+        )
 
 
 class JSONEncoder(json.JSONEncoder):
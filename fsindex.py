@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import fnmatch
+import os
+import pathlib
+import re
+import stat as statmod
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from buildtools.stats import counters
+
+PathLike = Union[str, pathlib.Path]
+
+# same rules as pathlib uses for glob patterns
+CASE_INSENSITIVE = os.name == "nt"
+WILDCARD_CHARS = re.compile(r"[*?\[]")
+
+
+class Listing(object):
+    def __init__(self, entries: List[os.DirEntry[str]], mtime_ns: Optional[int]):
+        self.entries: Dict[str, os.DirEntry[str]] = {
+            os.path.normcase(entry.name): entry for entry in entries
+        }
+        self.mtime_ns = mtime_ns
+        self.generation = 0
+        # cached DirEntry stat results are only valid in the generation they were read
+        self.fresh = True
+
+
+Selector = Tuple[str, Optional[Callable[[str], Optional[re.Match[str]]]], str]
+
+
+class FileSystemIndex(object):
+    """Lazily populated directory listings shared by all globs of a run
+
+    Listings are read once with os.scandir and DirEntry stat results are reused. If the
+    index outlives a single run, call refresh() so listings are revalidated against the
+    directory mtime before reuse.
+    """
+
+    def __init__(self, persistent: bool = False):
+        # persistent indices record directory mtimes so that they can be revalidated
+        self.persistent = persistent
+        self.generation = 0
+        self.listings: Dict[str, Optional[Listing]] = {}
+        self.stats: Dict[str, Optional[os.stat_result]] = {}
+
+    @staticmethod
+    def key(path: PathLike) -> str:
+        return os.path.normcase(os.path.abspath(path))
+
+    def refresh(self) -> None:
+        self.generation += 1
+        self.stats.clear()
+        if not self.persistent:
+            self.listings.clear()
+            return
+
+        # missing directories have no mtime to revalidate against
+        for key, listing in list(self.listings.items()):
+            if listing is None:
+                del self.listings[key]
+
+    def invalidate(self, path: PathLike) -> None:
+        key = self.key(path)
+        parent = os.path.dirname(key)
+        prefix = os.path.join(key, "")
+        for k in list(self.listings):
+            if k == key or k == parent or k.startswith(prefix):
+                del self.listings[k]
+        for k in list(self.stats):
+            if k == key or k.startswith(prefix):
+                del self.stats[k]
+
+    def _read(self, key: str) -> Optional[Listing]:
+        mtime_ns: Optional[int] = None
+        try:
+            if self.persistent:
+                # stat before reading so that concurrent changes invalidate next time
+                counters["fs stats"] += 1
+                mtime_ns = os.stat(key).st_mtime_ns
+            counters["fs reads"] += 1
+            with os.scandir(key) as it:
+                listing = Listing(list(it), mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except PermissionError:
+            listing = Listing([], mtime_ns)
+
+        listing.generation = self.generation
+        return listing
+
+    def _listing(self, key: str) -> Optional[Listing]:
+        try:
+            listing = self.listings[key]
+        except KeyError:
+            listing = self.listings[key] = self._read(key)
+            return listing
+
+        if listing is None or listing.generation == self.generation:
+            return listing
+
+        try:
+            counters["fs stats"] += 1
+            mtime_ns = os.stat(key).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+
+        if mtime_ns is not None and mtime_ns == listing.mtime_ns:
+            listing.generation = self.generation
+            listing.fresh = False
+            return listing
+
+        listing = self.listings[key] = self._read(key)
+        return listing
+
+    def listdir(self, path: PathLike) -> Optional[Dict[str, os.DirEntry[str]]]:
+        counters["fs lookups"] += 1
+        listing = self._listing(self.key(path))
+        if listing is None:
+            return None
+        return listing.entries
+
+    def _entry(
+        self, key: str
+    ) -> Tuple[Optional[Listing], Optional[os.DirEntry[str]], bool]:
+        parent, name = os.path.split(key)
+        if not name or name in (os.curdir, os.pardir):
+            return None, None, False
+
+        listing = self._listing(parent)
+        if listing is None:
+            return None, None, True
+        return listing, listing.entries.get(name, None), True
+
+    def stat(self, path: PathLike) -> Optional[os.stat_result]:
+        counters["fs lookups"] += 1
+        key = self.key(path)
+        try:
+            return self.stats[key]
+        except KeyError:
+            pass
+
+        listing, entry, known = self._entry(key)
+        result: Optional[os.stat_result] = None
+        if known and entry is None:
+            result = None
+        else:
+            counters["fs stats"] += 1
+            try:
+                if entry is not None and listing is not None and listing.fresh:
+                    result = entry.stat()
+                else:
+                    result = os.stat(key)
+            except OSError:
+                result = None
+
+        self.stats[key] = result
+        return result
+
+    def exists(self, path: PathLike) -> bool:
+        counters["fs lookups"] += 1
+        key = self.key(path)
+        _, entry, known = self._entry(key)
+        if known and (entry is None or not entry.is_symlink()):
+            return entry is not None
+        # dangling symlinks don't exist
+        return self.stat(key) is not None
+
+    def is_dir(self, path: PathLike) -> bool:
+        counters["fs lookups"] += 1
+        key = self.key(path)
+        _, entry, known = self._entry(key)
+        if known:
+            return entry is not None and self._entry_is_dir(entry)
+
+        result = self.stat(key)
+        return result is not None and statmod.S_ISDIR(result.st_mode)
+
+    def is_file(self, path: PathLike) -> bool:
+        return self.exists(path) and not self.is_dir(path)
+
+    @staticmethod
+    def _entry_is_dir(entry: os.DirEntry[str]) -> bool:
+        try:
+            if entry.is_symlink():
+                counters["fs stats"] += 1
+            return entry.is_dir()
+        except OSError:
+            return False
+
+    def walk(self, path: PathLike) -> Iterator[pathlib.Path]:
+        # everything below path, same order as Path.glob("**/*")
+        return self.glob(path, "**/*")
+
+    def glob(self, root: PathLike, pattern: PathLike) -> Iterator[pathlib.Path]:
+        root = pathlib.Path(root)
+        parts = list(pathlib.PurePath(pattern).parts)
+        if isinstance(pattern, str) and pattern[-1:] in (os.sep, os.altsep):
+            # trailing separator only matches directories
+            parts.append("")
+        if not parts:
+            raise ValueError(f"Unacceptable pattern: {pattern!r}")
+        if pathlib.PurePath(pattern).anchor:
+            raise NotImplementedError("Non-relative patterns are unsupported")
+
+        selectors: List[Selector] = []
+        for part in parts:
+            if part == "**":
+                selectors.append(("recursive", None, part))
+            elif "**" in part:
+                raise ValueError(
+                    "Invalid pattern: '**' can only be an entire path component"
+                )
+            elif WILDCARD_CHARS.search(part):
+                flags = re.IGNORECASE if CASE_INSENSITIVE else 0
+                regex = re.compile(fnmatch.translate(part), flags)
+                selectors.append(("wildcard", regex.fullmatch, part))
+            else:
+                selectors.append(("precise", None, part))
+
+        if not self.is_dir(root):
+            return iter([])
+        return self._select(root, selectors, 0)
+
+    def _select(
+        self, path: pathlib.Path, selectors: List[Selector], index: int
+    ) -> Iterator[pathlib.Path]:
+        if index == len(selectors):
+            yield path
+            return
+
+        kind, match, part = selectors[index]
+        dironly = index + 1 < len(selectors)
+
+        if kind == "precise":
+            child = path / part
+            if self.is_dir(child) if dironly else self.exists(child):
+                yield from self._select(child, selectors, index + 1)
+
+        elif kind == "wildcard":
+            assert match is not None
+            entries = self.listdir(path) or {}
+            for entry in list(entries.values()):
+                if dironly and not self._entry_is_dir(entry):
+                    continue
+                if match(entry.name):
+                    yield from self._select(path / entry.name, selectors, index + 1)
+
+        else:
+            yielded: Set[pathlib.Path] = set()
+            for start in self._iterate_directories(path):
+                for p in self._select(start, selectors, index + 1):
+                    if p not in yielded:
+                        yield p
+                        yielded.add(p)
+
+    def _iterate_directories(self, path: pathlib.Path) -> Iterator[pathlib.Path]:
+        yield path
+        entries = self.listdir(path) or {}
+        for entry in list(entries.values()):
+            # same as pathlib, don't follow symlinks when recursing
+            if self._entry_is_dir(entry) and not entry.is_symlink():
+                yield from self._iterate_directories(path / entry.name)
+
+
+RECURSIVE = "**"
+
+
+class GlobPattern(object):
+    """Absolute glob pattern matched one path segment at a time
+
+    States are indices into the pattern segments, the pattern matches once the last
+    segment has been consumed. Semantics are the same as for Path.glob.
+    """
+
+    def __init__(self, pattern: PathLike):
+        self.pattern = str(pattern)
+        parts = pathlib.PurePath(os.path.normpath(pattern)).parts
+        if not parts or not pathlib.PurePath(pattern).anchor:
+            raise ValueError(f"Pattern must be absolute: {pattern!r}")
+
+        self.anchor = parts[0]
+        self.segments: List[Union[str, Callable[[str], bool]]] = []
+        # matches any name, used to detect excludes covering whole subtrees
+        self.match_any: List[bool] = []
+        for part in parts[1:]:
+            if part == RECURSIVE:
+                self.segments.append(RECURSIVE)
+            elif "**" in part:
+                raise ValueError(
+                    "Invalid pattern: '**' can only be an entire path component"
+                )
+            elif WILDCARD_CHARS.search(part):
+                flags = re.IGNORECASE if CASE_INSENSITIVE else 0
+                regex = re.compile(fnmatch.translate(part), flags)
+                self.segments.append(
+                    lambda name, fullmatch=regex.fullmatch: fullmatch(name) is not None
+                )
+            else:
+                literal = os.path.normcase(part)
+                self.segments.append(
+                    lambda name, literal=literal: os.path.normcase(name) == literal
+                )
+            self.match_any.append(part == "*")
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def literal_prefix(self) -> pathlib.Path:
+        # deepest directory that has to be walked, the last segment is always matched
+        # against directory entries
+        path = pathlib.Path(self.anchor)
+        for part in pathlib.PurePath(os.path.normpath(self.pattern)).parts[1:-1]:
+            if part == RECURSIVE or WILDCARD_CHARS.search(part):
+                break
+            path = path / part
+        return path
+
+    def closure(self, states: Set[int]) -> Set[int]:
+        result = set(states)
+        for state in sorted(states):
+            while state < len(self) and self.segments[state] == RECURSIVE:
+                state += 1
+                result.add(state)
+        return result
+
+    def step(
+        self, states: Set[int], name: str, is_dir: bool, is_symlink: bool = False
+    ) -> Tuple[Set[int], bool]:
+        """Consume a path segment, returns new states and whether the path matched"""
+        result: Set[int] = set()
+        matched = False
+        for state in self.closure(states):
+            if state == len(self):
+                continue
+            segment = self.segments[state]
+            if segment == RECURSIVE:
+                # same as pathlib, ** doesn't recurse into symlinked directories
+                if is_dir and not is_symlink:
+                    result.add(state)
+            elif segment(name):  # type: ignore
+                result.add(state + 1)
+                if state + 1 == len(self):
+                    matched = True
+
+        if is_dir and len(self) in self.closure(result):
+            matched = True
+        return result, matched
+
+    def covers_children(self, states: Set[int]) -> bool:
+        # every child of the current directory will match
+        last = len(self) - 1
+        return last in self.closure(states) and self.match_any[last]
+
+    def initial(self, path: pathlib.Path) -> Tuple[Set[int], bool]:
+        """States after consuming the directory path and whether it or any of its
+        ancestors matched"""
+        parts = path.parts
+        if os.path.normcase(parts[0]) != os.path.normcase(self.anchor):
+            return set(), False
+
+        states: Set[int] = {0}
+        matched = False
+        for part in parts[1:]:
+            states, m = self.step(states, part, True)
+            matched = matched or m
+        return states, matched
+
+
+class PathMatcher(object):
+    """Include and exclude glob patterns compiled into one directory walk
+
+    Directories are only entered if an include can still match something below them
+    and no exclude matches them or all of their children, so excluded trees are never
+    read. Matching a directory with an include includes everything below it, matching it
+    with an exclude excludes everything below it.
+    """
+
+    def __init__(self, includes: Iterable[PathLike], excludes: Iterable[PathLike] = ()):
+        self.includes = [GlobPattern(p) for p in includes]
+        self.excludes = [GlobPattern(p) for p in excludes]
+
+    def excluded(self, path: PathLike, is_dir: bool) -> bool:
+        path = pathlib.Path(os.path.abspath(path))
+        for exclude in self.excludes:
+            states, matched = exclude.initial(path.parent)
+            if matched:
+                return True
+            _, matched = exclude.step(states, path.name, is_dir)
+            if matched:
+                return True
+        return False
+
+    def roots(self) -> List[pathlib.Path]:
+        roots: List[pathlib.Path] = []
+        keys: List[str] = []
+        for include in self.includes:
+            root = include.literal_prefix()
+            key = os.path.join(FileSystemIndex.key(root), "")
+            if any(key.startswith(k) for k in keys):
+                continue
+            # a later root may contain earlier ones
+            for i in reversed(range(len(keys))):
+                if keys[i].startswith(key):
+                    del keys[i]
+                    del roots[i]
+            roots.append(root)
+            keys.append(key)
+        return roots
+
+    def walk(self, fs: FileSystemIndex) -> Iterator[Tuple[pathlib.Path, bool]]:
+        # yields matched paths and whether they matched a pattern or only a parent did
+        for root in self.roots():
+            if not fs.is_dir(root):
+                continue
+
+            exclude_states: List[Set[int]] = []
+            excluded = False
+            for exclude in self.excludes:
+                states, matched = exclude.initial(root)
+                excluded = excluded or matched
+                exclude_states.append(states)
+            if excluded:
+                continue
+
+            include_states: List[Set[int]] = []
+            included = False
+            for include in self.includes:
+                states, matched = include.initial(root)
+                included = included or matched
+                include_states.append(states)
+
+            if included:
+                yield root, True
+            yield from self._walk(fs, root, include_states, exclude_states, included)
+
+    def _walk(
+        self,
+        fs: FileSystemIndex,
+        path: pathlib.Path,
+        include_states: List[Set[int]],
+        exclude_states: List[Set[int]],
+        included: bool,
+    ) -> Iterator[Tuple[pathlib.Path, bool]]:
+        entries = fs.listdir(path) or {}
+        for entry in list(entries.values()):
+            is_dir = fs._entry_is_dir(entry)
+            is_symlink = is_dir and entry.is_symlink()
+            child = path / entry.name
+
+            child_excludes: List[Set[int]] = []
+            excluded = False
+            covered = False
+            for exclude, states in zip(self.excludes, exclude_states):
+                states, matched = exclude.step(states, entry.name, is_dir, is_symlink)
+                if matched:
+                    excluded = True
+                    break
+                covered = covered or exclude.covers_children(states)
+                child_excludes.append(states)
+            if excluded:
+                continue
+
+            child_includes: List[Set[int]] = []
+            direct = False
+            live = False
+            for include, states in zip(self.includes, include_states):
+                states, matched = include.step(states, entry.name, is_dir, is_symlink)
+                direct = direct or matched
+                live = live or bool(states)
+                child_includes.append(states)
+
+            child_included = included or direct
+            if child_included:
+                yield child, direct
+
+            if not is_dir or covered:
+                continue
+            # included directories are walked whole, symlinks too
+            if child_included or live:
+                yield from self._walk(
+                    fs, child, child_includes, child_excludes, child_included
+                )
@@ -23,17 +23,31 @@ from __future__ import annotations
 
 import argparse
 import collections
+import os
 import pathlib
-import shutil
 from typing import Dict, Iterable, Optional, Set, Tuple
 import zipfile
-from buildtools import common
+from buildtools import common, sync
+from buildtools.archive import (
+    AUTO,
+    ArchiveStats,
+    CompressionPolicy,
+    PreviousArchive,
+    write_entries,
+)
 from buildtools.datatypes import Config, Dependency, PathLike
 
 
 def run(config: Config, args: argparse.Namespace):
     zipfiles = build_file_list(config)
-    package(config, zipfiles, args.verbose > 0)
+    package(
+        config,
+        zipfiles,
+        args.verbose > 0,
+        common.jobs_count(args.jobs),
+        full=args.full,
+        checksum=args.checksum,
+    )
 
 
 class ZipFiles(object):
@@ -69,10 +83,19 @@ class ZipFiles(object):
         is_dir: bool = False,
     ) -> None:
         name = pathlib.Path(name)
-        if name.is_dir():
-            for _name in name.glob("**/*"):
+        if self.config.fs.is_dir(name):
+            for _name in self.config.fs.walk(name):
                 # force dst to a dir since likely writing multiple files there
                 self.append(_name, src, dst, is_dir=True)
+        self._add(name, src, dst, is_dir)
+
+    def _add(
+        self,
+        name: pathlib.Path,
+        src: Optional[PathLike],
+        dst: Optional[PathLike],
+        is_dir: bool,
+    ) -> None:
         if dst is None:
             dst = name.relative_to(self.config.root)
         else:
@@ -82,14 +105,14 @@ class ZipFiles(object):
                 rel_path = name.name
             else:
                 rel_path = name.relative_to(src)
-            if dst.is_dir() or is_dir:
+            if is_dir or self.config.fs.is_dir(dst):
                 dst = dst / rel_path
         self.files[name].add(dst)
 
     def remove(self, name: PathLike) -> None:
         name = pathlib.Path(name)
-        if name.is_dir():
-            for _name in name.glob("**/*"):
+        if self.config.fs.is_dir(name):
+            for _name in self.config.fs.walk(name):
                 self.remove(_name)
         if name in self.files:
             del self.files[name]
@@ -108,6 +131,31 @@ class ZipFiles(object):
         for file in self._glob(pattern):
             self.remove(file)
 
+    def add_matching(
+        self,
+        includes: Iterable[PathLike],
+        excludes: Iterable[PathLike] = (),
+        destination: Optional[PathLike] = None,
+        src: Optional[PathLike] = None,
+        is_dir: bool = False,
+    ) -> None:
+        # same result as include() for every pattern followed by exclude() but excluded
+        # trees are never walked
+        config = self.config
+        matcher = config.matcher(
+            [common.resolve_path(p, config) for p in includes],
+            [common.resolve_path(p, config) for p in excludes],
+        )
+
+        if matcher.excludes:
+            for name in list(self.files):
+                if matcher.excluded(name, config.fs.is_dir(name)):
+                    del self.files[name]
+
+        for name, matched in matcher.walk(config.fs):
+            # files inside matched directories always go into dst dirs, same as append
+            self._add(name, src, destination, is_dir or not matched)
+
     def map(self, src: PathLike, dst: PathLike) -> None:
         dst = common.resolve_path(dst, self.config)
 
@@ -116,8 +164,19 @@ class ZipFiles(object):
 
 
 def build_parser(parser: argparse.ArgumentParser):
+    common.add_verbose_option(parser)
+    common.add_jobs_option(parser)
     parser.add_argument(
-        "-v", "--verbose", action="count", help="Increase output verbosity", default=0
+        "--full",
+        help="Recompress everything instead of reusing the previous archive",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--checksum",
+        help="Compare contents of files with different mtimes in directory mode",
+        action="store_true",
+        default=False,
     )
 
 
@@ -128,13 +187,23 @@ def main():
 
     args = parser.parse_args()
 
-    config = common.load_config(args.config)
+    config = common.load_config(args.config, args.config_cache)
 
     with common.chdir(config.root):
         run(config, args)
 
+    if args.verbose > 0:
+        common.print_stats()
+
 
-def package(config: Config, file_list: ZipFiles, verbose: bool) -> None:
+def package(
+    config: Config,
+    file_list: ZipFiles,
+    verbose: bool,
+    jobs: int = 1,
+    full: bool = False,
+    checksum: bool = False,
+) -> None:
     package = config.package
 
     compression = package.compression_value
@@ -150,20 +219,65 @@ def package(config: Config, file_list: ZipFiles, verbose: bool) -> None:
     if compression is None:
         archive = archive.with_suffix("")
         archive.mkdir(exist_ok=True)
-        for src, _dst in file_list.items():
-            dst = archive / _dst
-            dst.parent.mkdir(parents=True, exist_ok=True)
-            if src.is_dir() or dst.is_dir():
-                continue
+
+        def copied(src: pathlib.Path, dst: pathlib.Path, strategy: str) -> None:
             if verbose:
-                print(f"Writing {src!s} -> {dst!s}")
-            shutil.copyfile(src, dst)
+                print(f"Writing {src!s} -> {dst!s} ({strategy})")
+
+        result = sync.mirror(
+            ((src, archive / dst) for src, dst in file_list.items()),
+            archive,
+            jobs,
+            checksum,
+            copied,
+            package.link,
+        )
+        print(f"Synced {archive!s}: {result.summary()}")
+        result.raise_errors()
     else:
-        with zipfile.ZipFile(archive, "w", compression=compression) as zip:
-            for src, dst in file_list.items():
-                if verbose:
-                    print(f"Writing {src!s} -> {dst!s}")
-                zip.write(src, dst)
+        # the previous archive is read while the new one is written next to it
+        output = archive.with_name(archive.name + ".tmp")
+        previous: Optional[PreviousArchive] = None
+        if not full and archive.exists():
+            try:
+                previous = PreviousArchive(archive)
+            except zipfile.BadZipFile:
+                print(f"Ignoring invalid previous archive {archive!s}")
+
+        def written(src: PathLike, dst: str) -> None:
+            if verbose:
+                print(f"Writing {src!s} -> {dst}")
+
+        policy = CompressionPolicy(
+            compression,
+            [(r.pattern, r.compression_value) for r in package.compression_rules],
+        )
+        stats = ArchiveStats()
+        # auto is only a per entry choice, the archive needs a real default
+        if compression == AUTO:
+            compression = zipfile.ZIP_DEFLATED
+
+        try:
+            with zipfile.ZipFile(output, "w", compression=compression) as zip:
+                write_entries(
+                    zip,
+                    ((src, str(dst)) for src, dst in file_list.items()),
+                    jobs,
+                    previous,
+                    written,
+                    policy,
+                    stats,
+                )
+        except BaseException:
+            output.unlink(missing_ok=True)
+            raise
+        finally:
+            if previous is not None:
+                previous.close()
+        os.replace(output, archive)
+
+        if verbose:
+            stats.report()
 
     print(archive)
 
@@ -172,12 +286,7 @@ def build_file_list(config: Config) -> ZipFiles:
     package = config.package
 
     zipfiles = ZipFiles(config)
-
-    for pattern in package.include:
-        zipfiles.include(pattern)
-
-    for pattern in package.exclude:
-        zipfiles.exclude(pattern)
+    zipfiles.add_matching(package.include, package.exclude)
 
     for file_map in package.map:
         zipfiles.map(file_map.source, file_map.destination)
@@ -186,11 +295,13 @@ def build_file_list(config: Config) -> ZipFiles:
         src = common.resolve_path(dep.path, config)
         dst = common.resolve_path(dep.destination, config)
 
-        for pattern in dep.include:
-            zipfiles.include(src / pattern, src=src, destination=dst, is_dir=True)
-
-        for pattern in dep.exclude:
-            zipfiles.exclude(src / pattern)
+        zipfiles.add_matching(
+            [src / pattern for pattern in dep.include],
+            [src / pattern for pattern in dep.exclude],
+            src=src,
+            destination=dst,
+            is_dir=True,
+        )
 
         for file_map in dep.map:
             _src = common.resolve_path(file_map.source, config)
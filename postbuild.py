@@ -22,15 +22,43 @@ Copyright (c) 2022 Daumantas Kavolis
 from __future__ import annotations
 
 import argparse
+import fnmatch
+import hashlib
 import json
+import logging
 import os
 import pathlib
 import shutil
-import subprocess
-from typing import Dict, Iterable
-
-from buildtools import common
-from buildtools.datatypes import FileCopy, JSONEncoder, PathLike, Config
+import sys
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from buildtools import common, sync
+from buildtools.datatypes import (
+    Config,
+    FileCopy,
+    JSONEncoder,
+    PathLike,
+    PostBuildAction,
+    PostBuildActionList,
+)
+
+if TYPE_CHECKING:
+    import subprocess
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
 
 
 def main():
@@ -40,31 +68,59 @@ def main():
 
     args = parser.parse_args()
 
-    config = common.load_config(args.config)
+    config = common.load_config(args.config, args.config_cache)
 
     with common.chdir(config.root):
         run(config, args)
 
+    if args.verbose > 0:
+        common.print_stats()
+
 
 def run(config: Config, args: argparse.Namespace):
-    post_build(config, args.config_name, args.target_path, args.dump_events)
+    targets: List[PathLike] = list(args.target_paths or [])
+    if args.targets_file is not None:
+        targets.extend(read_targets_file(args.targets_file))
+    if not targets:
+        sys.exit("No post build targets, pass --target or --targets-file")
+
+    post_build_all(
+        config,
+        args.config_name,
+        targets,
+        args.dump_events,
+        common.jobs_count(args.jobs),
+    )
 
 
-def update_config(config: Config, configuration_name: str, target_path: PathLike):
-    config.variables["ConfigurationName"] = configuration_name
-    config.variables.update(split_target_path(target_path))
+def read_targets_file(filename: PathLike) -> List[str]:
+    targets: List[str] = []
+    with open(filename) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                targets.append(line)
+    return targets
 
-    events = config.post_build
 
-    target_key = f"[{config.variables['TargetName']}]"
+def target_events(
+    events: PostBuildAction, configuration_name: str, target_name: str
+) -> PostBuildActionList:
+    merged = PostBuildActionList(events.clean, events.install)
+
+    def update(value: PostBuildActionList) -> None:
+        merged.clean = value.clean
+        merged.install = value.install
+
+    target_key = f"[{target_name}]"
 
     for key, value in events.per_target.items():
         if key[0] == "|" and key[1:] == configuration_name:
-            events.update(value)
+            update(value)
             continue
 
         if key.startswith("|!") and key[2:] != configuration_name:
-            events.update(value)
+            update(value)
             continue
 
         if not key.startswith(target_key):
@@ -72,7 +128,7 @@ def update_config(config: Config, configuration_name: str, target_path: PathLike
 
         # exact match
         if key == target_key:
-            events.update(value)
+            update(value)
             continue
 
         suffix = key[len(target_key) :]
@@ -86,12 +142,34 @@ def update_config(config: Config, configuration_name: str, target_path: PathLike
 
         # exact configuration match
         if modifier == configuration_name:
-            events.update(value)
+            update(value)
             continue
 
         # negative match
         if modifier[0] == "!" and modifier[1:] != configuration_name:
-            events.update(value)
+            update(value)
+
+    return merged
+
+
+def target_config(
+    config: Config, configuration_name: str, target_path: PathLike
+) -> Config:
+    variables = split_target_path(target_path)
+    variables["ConfigurationName"] = configuration_name
+    return config.with_variables(variables)
+
+
+def update_config(config: Config, configuration_name: str, target_path: PathLike):
+    config.variables["ConfigurationName"] = configuration_name
+    config.variables.update(split_target_path(target_path))
+
+    events = config.post_build
+    events.update(
+        target_events(
+            events, configuration_name, str(config.variables["TargetName"])
+        )
+    )
 
 
 def post_build(
@@ -99,34 +177,84 @@ def post_build(
     configuration_name: str,
     target_path: PathLike,
     dump_events: bool = False,
+    jobs: int = 1,
 ) -> None:
-    update_config(config, configuration_name, target_path)
-    events = config.post_build
+    post_build_all(config, configuration_name, [target_path], dump_events, jobs)
+
+
+def post_build_all(
+    config: Config,
+    configuration_name: str,
+    target_paths: Iterable[PathLike],
+    dump_events: bool = False,
+    jobs: int = 1,
+) -> None:
+    # the base config is left untouched, each target gets its own variables
+    targets: List[Tuple[Config, PostBuildActionList]] = []
+    for target_path in target_paths:
+        target = target_config(config, configuration_name, target_path)
+        events = target_events(
+            config.post_build,
+            configuration_name,
+            str(target.variables["TargetName"]),
+        )
+        targets.append((target, events))
 
     if dump_events:
-        print(
-            json.dumps(
-                {
-                    "pdb2mdb": events.pdb2mdb,
-                    "clean": events.clean,
-                    "install": events.install,
-                },
-                indent=4,
-                cls=JSONEncoder,
+        for target, events in targets:
+            print(
+                json.dumps(
+                    {
+                        "target": target.variables["TargetPath"],
+                        "pdb2mdb": config.post_build.pdb2mdb,
+                        "clean": events.clean,
+                        "install": events.install,
+                    },
+                    indent=4,
+                    cls=JSONEncoder,
+                )
             )
-        )
 
-    if events.pdb2mdb is not None:
-        pdb2mdb(
-            common.resolve_path(events.pdb2mdb, config),
-            str(config.variables["TargetPath"]),
+    # pdb2mdb runs in the background, only installs that need its output wait for it
+    background: List[Pdb2Mdb] = []
+    if config.post_build.pdb2mdb is not None:
+        for target, _ in targets:
+            job = Pdb2Mdb(
+                common.resolve_path(config.post_build.pdb2mdb, target),
+                str(target.variables["TargetPath"]),
+            )
+            if job.up_to_date():
+                print(f"Skipping pdb2mdb, {job.output!s} is up to date")
+            else:
+                job.start()
+                background.append(job)
+
+    # actions shared between targets are only done once
+    paths: List[pathlib.Path] = []
+    destinations: List[pathlib.Path] = []
+    for target, events in targets:
+        paths.extend(common.resolve_path(str(path), target) for path in events.clean)
+        destinations.extend(
+            common.resolve_path(item.destination, target) for item in events.install
         )
+    paths = unique(paths, key=path_key)
 
-    if events.clean:
-        clean(events.clean, config)
+    # cleaned directories that are installed into again are mirrored instead
+    mirrors = mirror_roots(paths, destinations, config)
+    removed = [p for p in paths if not within_any(p, mirrors)]
+    for job in background:
+        if overlaps(job.output, removed) or overlaps(job.target, removed):
+            job.wait(config)
+    remove_paths(removed, config)
 
-    if events.install:
-        install(events.install, config)
+    copies: List[Tuple[pathlib.Path, pathlib.Path]] = []
+    for target, events in targets:
+        copies.extend(plan_install(events.install, target, background))
+    copies = unique(copies, key=lambda c: (path_key(c[0]), path_key(c[1])))
+    install_paths(copies, config, mirrors, config.post_build.link, jobs, background)
+
+    for job in background:
+        job.wait(config)
 
 
 def build_parser(parser: argparse.ArgumentParser) -> None:
@@ -138,7 +266,17 @@ def build_parser(parser: argparse.ArgumentParser) -> None:
         default="__NoName__",
     )
     parser.add_argument(
-        "-t", "--target", required=True, help="Target path", dest="target_path"
+        "-t",
+        "--target",
+        help="Target path, can be given multiple times",
+        dest="target_paths",
+        action="append",
+    )
+    parser.add_argument(
+        "--targets-file",
+        help="File listing target paths, one per line",
+        dest="targets_file",
+        default=None,
     )
     parser.add_argument(
         "--dump-events",
@@ -148,6 +286,9 @@ def build_parser(parser: argparse.ArgumentParser) -> None:
         action="store_true",
         default=False,
     )
+    # installs are mostly waiting on the disk so use more threads than CPUs
+    common.add_jobs_option(parser, default=4)
+    common.add_verbose_option(parser)
 
 
 def split_target_path(target: PathLike) -> Dict[str, str]:
@@ -166,34 +307,357 @@ def split_target_path(target: PathLike) -> Dict[str, str]:
 
 
 def pdb2mdb(path: PathLike, target: PathLike) -> None:
-    print(f"Calling '{path} {target}'")
-    subprocess.call([path, target])
+    job = Pdb2Mdb(path, target)
+    if job.up_to_date():
+        print(f"Skipping pdb2mdb, {job.output!s} is up to date")
+        return
+    job.start()
+    job.wait()
+
+
+class Pdb2Mdb(object):
+    """pdb2mdb of a single target running in the background"""
+
+    def __init__(self, command: PathLike, target: PathLike):
+        self.command = command
+        self.target = pathlib.Path(target)
+        self.output = pathlib.Path(f"{target}.mdb")
+        # outside of $(TargetName).* so that it is not installed with the outputs
+        self.record = self.target.with_name(f".{self.target.name}.mdb.sha1")
+        self.process: Optional[subprocess.Popen[bytes]] = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None
+
+    def inputs(self) -> List[pathlib.Path]:
+        paths = [self.target, self.target.with_suffix(".pdb")]
+        return [path for path in paths if path.exists()]
+
+    def digest(self) -> str:
+        digest = hashlib.sha1()
+        for path in self.inputs():
+            digest.update(sync.file_digest(path).encode("ascii"))
+        return digest.hexdigest()
+
+    def up_to_date(self) -> bool:
+        try:
+            mtime_ns = self.output.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if all(path.stat().st_mtime_ns < mtime_ns for path in self.inputs()):
+            return True
+
+        # rebuilds with identical outputs only touch the timestamps
+        try:
+            recorded = self.record.read_text().strip()
+        except FileNotFoundError:
+            return False
+        return recorded == self.digest()
+
+    def start(self) -> None:
+        import subprocess
+
+        print(f"Calling '{self.command} {self.target}'")
+        self.process = subprocess.Popen([self.command, self.target])
+
+    def wait(self, config: Optional[Config] = None) -> None:
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        code = process.wait()
+        if config is not None:
+            config.fs.invalidate(self.output)
+        if code != 0:
+            logger.warning("pdb2mdb exited with code %d for %s", code, self.target)
+            return
+        self.record.write_text(self.digest())
+
+    def matches(self, pattern: PathLike) -> bool:
+        return fnmatch.fnmatch(
+            os.path.normcase(self.output), os.path.normcase(pattern)
+        )
+
+    def blocks(self, src: pathlib.Path, dst: pathlib.Path) -> bool:
+        """Whether copying src to dst has to wait for pdb2mdb to finish"""
+        if not self.running:
+            return False
+        return overlaps(src, [self.output]) or overlaps(
+            dst, [self.output, *self.inputs()]
+        )
+
+
+def path_key(path: pathlib.Path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def unique(items: Iterable[T], key: Callable[[T], Hashable]) -> List[T]:
+    seen: Set[Hashable] = set()
+    result: List[T] = []
+    for item in items:
+        k = key(item)
+        if k in seen:
+            continue
+        seen.add(k)
+        result.append(item)
+    return result
+
+
+def is_within(path: PathLike, root: PathLike) -> bool:
+    key = path_key(pathlib.Path(path))
+    root_key = path_key(pathlib.Path(root))
+    return key == root_key or key.startswith(os.path.join(root_key, ""))
+
+
+def within_any(path: PathLike, roots: Iterable[PathLike]) -> bool:
+    return any(is_within(path, root) for root in roots)
+
+
+def mirror_roots(
+    paths: Iterable[pathlib.Path],
+    destinations: Iterable[pathlib.Path],
+    config: Config,
+) -> List[pathlib.Path]:
+    destinations = list(destinations)
+    roots = [
+        path
+        for path in paths
+        if not config.fs.is_file(path)
+        and any(is_within(dst, path) for dst in destinations)
+    ]
+    # nested clean paths are covered by the outermost mirror
+    return [
+        root
+        for root in roots
+        if not any(o is not root and is_within(root, o) for o in roots)
+    ]
+
+
+def overlaps(path: pathlib.Path, paths: Iterable[pathlib.Path]) -> bool:
+    return any(is_within(path, p) or is_within(p, path) for p in paths)
+
+
+class InstallPlan(object):
+    """File level copies of a batch of installs, run together on a thread pool"""
+
+    def __init__(self) -> None:
+        self.files: Dict[str, Tuple[pathlib.Path, pathlib.Path]] = {}
+        self.directories: Dict[str, Tuple[pathlib.Path, pathlib.Path]] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        self.sources: List[pathlib.Path] = []
+        self.destinations: List[pathlib.Path] = []
+        self.errors: List[Tuple[pathlib.Path, Exception]] = []
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.sources)
+
+    def is_dir(self, path: pathlib.Path, config: Config) -> bool:
+        return path_key(path) in self.directories or config.fs.is_dir(path)
+
+    def exists(self, path: pathlib.Path, config: Config) -> bool:
+        key = path_key(path)
+        return key in self.directories or key in self.files or config.fs.exists(path)
+
+    def add_file(self, path: pathlib.Path, dst: pathlib.Path) -> None:
+        key = path_key(dst)
+        if key in self.files and path_key(self.files[key][0]) != path_key(path):
+            logger.warning(
+                "%s is installed from both %s and %s, keeping the latter",
+                dst,
+                self.files[key][0],
+                path,
+            )
+        self.files[key] = (path, dst)
+
+    def add(self, path: pathlib.Path, dst: pathlib.Path, config: Config) -> None:
+        self.sources.append(path)
+        self.destinations.append(dst)
+        if not config.fs.is_dir(path):
+            # same as shutil.copy, copying into a directory keeps the name
+            if self.is_dir(dst, config):
+                dst = dst / path.name
+            self.add_file(path, dst)
+            return
+
+        # same as shutil.copytree, symlinked directories are copied as directories
+        if self.exists(dst, config):
+            self.errors.append((dst, FileExistsError(f"{dst!s} already exists")))
+            return
+        self.directories[path_key(dst)] = (path, dst)
+        for directory, dirnames, filenames in os.walk(path, followlinks=True):
+            src_dir = pathlib.Path(directory)
+            dst_dir = dst / src_dir.relative_to(path)
+            for name in dirnames:
+                self.directories[path_key(dst_dir / name)] = (
+                    src_dir / name,
+                    dst_dir / name,
+                )
+            for name in filenames:
+                self.add_file(src_dir / name, dst_dir / name)
+
+    def run(self, config: Config, link: str = "copy", jobs: int = 1) -> sync.SyncResult:
+        result = sync.SyncResult()
+        result.errors.extend(self.errors)
+
+        # directories are created once up front instead of by every copy
+        directories = {
+            path_key(dst.parent): dst.parent for _, dst in self.files.values()
+        }
+        directories.update((key, dst) for key, (_, dst) in self.directories.items())
+        for key in sorted(directories):
+            try:
+                directories[key].mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                result.errors.append((directories[key], e))
+
+        def report(src: pathlib.Path, dst: pathlib.Path, strategy: str) -> None:
+            print(f"  {strategy}: {src!s} -> {dst!s}")
+
+        callback = report if link != "copy" else None
+        sync.copy_files(self.files.values(), jobs, link, callback, result)
+        for dst in self.destinations:
+            config.fs.invalidate(dst.parent)
+        self.files.clear()
+        self.directories.clear()
+        self.reset()
+        return result
+
+
+class MirrorPlan(InstallPlan):
+    """Final state of a cleaned directory after installing into it"""
+
+    def __init__(self, root: pathlib.Path):
+        super().__init__()
+        self.root = root
+        self.synced = False
+
+    def is_dir(self, path: pathlib.Path, config: Config) -> bool:
+        return path_key(path) in self.directories
+
+    def exists(self, path: pathlib.Path, config: Config) -> bool:
+        key = path_key(path)
+        return key in self.directories or key in self.files
+
+    def run(self, config: Config, link: str = "copy", jobs: int = 1) -> sync.SyncResult:
+        entries = list(self.directories.values()) + list(self.files.values())
+        result = sync.mirror(entries, self.root, jobs, link=link)
+        result.errors[:0] = self.errors
+        config.fs.invalidate(self.root)
+        print(f"Synced {self.root!s}: {result.summary()}")
+        # the mirrored state is kept for later syncs of the same root
+        self.synced = True
+        self.reset()
+        return result
+
+
+def install_paths(
+    copies: Iterable[Tuple[pathlib.Path, pathlib.Path]],
+    config: Config,
+    mirrors: List[pathlib.Path],
+    link: str = "copy",
+    jobs: int = 1,
+    background: Iterable[Pdb2Mdb] = (),
+) -> None:
+    batch = InstallPlan()
+    plans = {path_key(root): MirrorPlan(root) for root in mirrors}
+    errors: List[Tuple[pathlib.Path, Exception]] = []
+
+    def run(plan: InstallPlan) -> None:
+        errors.extend(plan.run(config, link, jobs).errors)
+
+    for path, dst in copies:
+        blocking = [job for job in background if job.blocks(path, dst)]
+        if blocking:
+            # copy what is already planned while waiting
+            if batch.pending:
+                run(batch)
+            for job in blocking:
+                job.wait(config)
+            if not config.fs.exists(path):
+                continue
+
+        root = next((root for root in mirrors if is_within(dst, root)), None)
+        if root is None:
+            plan = batch
+        else:
+            plan = plans[path_key(root)]
+
+        # pending copies have to finish before their outputs are read or their
+        # sources are overwritten
+        for pending in [batch, *plans.values()]:
+            if pending.pending and (
+                overlaps(path, pending.destinations) or overlaps(dst, pending.sources)
+            ):
+                run(pending)
+
+        if root is not None:
+            print(f"Mirroring {path!s} -> {dst!s}")
+        elif config.fs.is_dir(path):
+            print(f"Copying tree {path!s} -> {dst!s}")
+        else:
+            print(f"Copying file {path!s} -> {dst!s}")
+        plan.add(path, dst, config)
+
+    for pending in [batch, *plans.values()]:
+        if pending.pending:
+            run(pending)
+
+    # nothing was installed into these, they end up removed as by a plain clean
+    unused = [plan.root for plan in plans.values() if not plan.synced]
+    for job in background:
+        if overlaps(job.output, unused) or overlaps(job.target, unused):
+            job.wait(config)
+    remove_paths(unused, config)
+
+    result = sync.SyncResult()
+    result.errors = errors
+    result.raise_errors()
 
 
 def clean(paths: Iterable[PathLike], config: Config):
+    remove_paths((common.resolve_path(str(path), config) for path in paths), config)
+
+
+def remove_paths(paths: Iterable[pathlib.Path], config: Config):
+    fs = config.fs
     for path in paths:
-        path = common.resolve_path(str(path), config)
-        if path.exists():
-            if path.is_dir():
+        if fs.exists(path):
+            if fs.is_dir(path):
                 print(f"Removing directory {path!s}")
                 shutil.rmtree(path)
             else:
                 print(f"Removing file {path!s}")
                 os.remove(path)
+            fs.invalidate(path)
 
 
-def install(mapping: Iterable[FileCopy], config: Config):
+def plan_install(
+    mapping: Iterable[FileCopy],
+    config: Config,
+    background: Iterable[Pdb2Mdb] = (),
+) -> List[Tuple[pathlib.Path, pathlib.Path]]:
+    copies: List[Tuple[pathlib.Path, pathlib.Path]] = []
     for item in mapping:
         src = common.resolve(item.source, config)
         dst = common.resolve_path(item.destination, config)
 
-        for path in config.glob(src):
-            if path.is_dir():
-                print(f"Copying tree {path!s} -> {dst!s}")
-                shutil.copytree(path, dst)
-            else:
-                print(f"Copying file {path!s} -> {dst!s}")
-                shutil.copy(path, dst)
+        paths = list(config.glob(src))
+        # outputs that pdb2mdb is still writing may not exist yet
+        for job in background:
+            if job.running and job.matches(os.path.join(config.root, src)):
+                paths.append(job.output)
+        for path in unique(paths, key=path_key):
+            copies.append((path, dst))
+    return copies
+
+
+def install(mapping: Iterable[FileCopy], config: Config, jobs: int = 1):
+    install_paths(
+        plan_install(mapping, config), config, [], config.post_build.link, jobs
+    )
 
 
 if __name__ == "__main__":
@@ -22,55 +22,399 @@ Copyright (c) 2022 Daumantas Kavolis
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import pathlib
 import re
-from typing import Any, List
-from buildtools import common
+import shutil
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from buildtools import common, sync
 from buildtools.datatypes import Substitution, Config, PathLike
+from buildtools.substitutions import SubstitutionPlan, compile_plan
 
 
-def run(config: Config, args: Any) -> None:
-    replace(config)
-
-
-def build_parser(parser: argparse.ArgumentParser) -> None:
-    pass
-
+logger = logging.getLogger(__name__)
 
-def replace(config: Config) -> None:
-    for patterns in config.replace.regex:
-        for filename in config.glob(common.resolve(patterns.pattern, config)):
-            replace_in_file(filename, patterns.substitutions, config)
+# plans of the current run in worker processes
+worker_plans: List[SubstitutionPlan] = []
 
-    for files in config.replace.template_files:
-        src = common.resolve_path(files.source, config)
-        dst = common.resolve_path(files.destination, config)
 
-        replace_in_file_all(src, dst, config)
+def run(config: Config, args: Any) -> None:
+    replace(
+        config, common.jobs_count(args.jobs), state_path(args.config), args.force
+    )
 
 
-def replace_in_file_all(src: PathLike, dst: PathLike, config: Config):
-    print(f"Updating {src!s} -> {dst!s}")
+def build_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--force",
+        help="Process all files even if they are up to date",
+        action="store_true",
+        default=False,
+    )
+    common.add_jobs_option(parser)
+    common.add_verbose_option(parser)
+
+
+def init_worker(plans: List[SubstitutionPlan]) -> None:
+    global worker_plans
+    worker_plans = plans
+
+
+def apply_in_worker(task: Tuple[PathLike, List[int]]) -> List[FileResult]:
+    filename, indices = task
+    return process_file(filename, [worker_plans[index] for index in indices])
+
+
+def state_path(config_file: PathLike) -> pathlib.Path:
+    return pathlib.Path(f"{os.fspath(config_file)}.replace-state")
+
+
+class ReplaceState(object):
+    """What the last run did to each file, so that unchanged files aren't read again
+
+    Files are keyed by their size and mtime after the last run and the hash of the
+    resolved substitutions that ran over them. Templates are keyed by the size and
+    mtime of both files and the values of the variables they reference.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename: Optional[PathLike] = None, force: bool = False):
+        self.filename = filename
+        self.files: Dict[str, Dict[str, List[Any]]] = {}
+        self.templates: Dict[str, List[Any]] = {}
+        if filename is not None and not force:
+            self.load(filename)
+        # entries of files that are gone are dropped on save
+        self.old_files, self.files = self.files, {}
+        self.old_templates, self.templates = self.templates, {}
+
+    def load(self, filename: PathLike) -> None:
+        try:
+            with open(filename, "r") as file:
+                data = json.load(file)
+            if data["version"] == self.VERSION:
+                self.files = data["files"]
+                self.templates = data["templates"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.warning("Ignoring unreadable replace state %s", filename)
+
+    def lookup(
+        self,
+        pattern: str,
+        filename: PathLike,
+        st: Optional[os.stat_result],
+        plan: SubstitutionPlan,
+    ) -> Optional[FileResult]:
+        entry = self.old_files.get(pattern, {}).get(os.fspath(filename))
+        if st is None or entry is None:
+            return None
+        if entry[:3] != [st.st_size, st.st_mtime_ns, plan.key]:
+            return None
+        result = FileResult(filename, entry[3], False)
+        result.skipped = True
+        result.stat = (st.st_size, st.st_mtime_ns)
+        return result
+
+    def record(self, pattern: str, result: FileResult, plan: SubstitutionPlan) -> None:
+        if result.error is None and result.stat is not None:
+            self.files.setdefault(pattern, {})[os.fspath(result.filename)] = [
+                *result.stat,
+                plan.key,
+                result.matches,
+            ]
+
+    def save(self) -> None:
+        if self.filename is None:
+            return
+        data = {
+            "version": self.VERSION,
+            "files": self.files,
+            "templates": self.templates,
+        }
+        try:
+            write_text(self.filename, json.dumps(data))
+        except OSError:
+            logger.warning("Failed to write replace state %s", self.filename)
+
+
+def replace(
+    config: Config,
+    jobs: int = 1,
+    state_file: Optional[PathLike] = None,
+    force: bool = False,
+) -> None:
+    state = ReplaceState(state_file, force)
+
+    # resolved and compiled once for all the matched files
+    plans = [compile_plan(p.substitutions, config) for p in config.replace.regex]
+    tasks: List[Tuple[int, PathLike]] = [
+        (index, filename)
+        for index, patterns in enumerate(config.replace.regex)
+        for filename in config.glob(common.resolve(patterns.pattern, config))
+    ]
+
+    # a file matched by several patterns is one task so that it is written once
+    files: Dict[str, Tuple[PathLike, List[int]]] = {}
+    for i, (_, filename) in enumerate(tasks):
+        files.setdefault(sync.path_key(filename), (filename, []))[1].append(i)
+
+    keys = [p.pattern for p in config.replace.regex]
+    results: List[Optional[FileResult]] = [None] * len(tasks)
+    pending: List[Tuple[PathLike, List[int]]] = []
+    for filename, positions in files.values():
+        st = config.fs.stat(filename)
+        cached = [
+            state.lookup(keys[tasks[i][0]], tasks[i][1], st, plans[tasks[i][0]])
+            for i in positions
+        ]
+        # patterns build on each other's output, rerun all of them if any is stale
+        if all(result is not None for result in cached):
+            for i, result in zip(positions, cached):
+                results[i] = result
+        else:
+            pending.append((filename, positions))
+
+    work = [(filename, [tasks[i][0] for i in ps]) for filename, ps in pending]
+    processed: Iterable[List[FileResult]]
+    if jobs > 1 and len(work) > 1:
+        # workers get the plans once and only file names after that
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_worker, initargs=(plans,)
+        ) as executor:
+            chunksize = max(1, len(work) // (jobs * 4))
+            processed = list(executor.map(apply_in_worker, work, chunksize=chunksize))
+    else:
+        processed = (
+            process_file(filename, [plans[index] for index in indices])
+            for filename, indices in work
+        )
+    for (_, positions), file_results in zip(pending, processed):
+        for i, result in zip(positions, file_results):
+            # reported under the name its own pattern matched it with
+            result.filename = tasks[i][1]
+            results[i] = result
+
+    for (index, _), result in zip(tasks, results):
+        assert result is not None
+        state.record(keys[index], result, plans[index])
+
+    # reported in glob order no matter which worker finished first
+    failed: Dict[str, FileResult] = {}
+    for index, patterns in enumerate(config.replace.regex):
+        pattern_results = [r for (i, _), r in zip(tasks, results) if i == index]
+        for result in pattern_results:
+            assert result is not None
+            report_file(result)
+            if result.error is not None:
+                failed.setdefault(sync.path_key(result.filename), result)
+        report_matches(patterns.pattern, plans[index], pattern_results)
+
+    # a failing template shouldn't throw away what the regex pass already did
+    try:
+        for files in config.replace.template_files:
+            src = common.resolve_path(files.source, config)
+            dst = common.resolve_path(files.destination, config)
+
+            replace_template(src, dst, config, state)
+    finally:
+        state.save()
+
+    if failed:
+        for result in failed.values():
+            logger.error("%s: %s", result.filename, result.error)
+        raise RuntimeError(f"Failed to replace in {len(failed)} files")
+
+
+class FileResult(object):
+    """Matches of each substitution in a file and whether it had to be rewritten"""
+
+    def __init__(
+        self,
+        filename: PathLike,
+        matches: List[int],
+        changed: bool,
+        error: Optional[Exception] = None,
+        ran: Optional[List[bool]] = None,
+    ):
+        self.filename = filename
+        self.matches = matches
+        self.changed = changed
+        self.error = error
+        # which substitutions got past the literal prefilter, empty if not processed
+        self.ran = ran or []
+        self.skipped = False
+        # size and mtime after processing
+        self.stat: Optional[Tuple[int, int]] = None
+
+
+def read_text(filename: PathLike) -> Optional[str]:
+    try:
+        with open(filename, "r", newline="") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_text(filename: PathLike, contents: str) -> None:
+    """Replace the file atomically keeping its permissions"""
+    filename = os.fspath(filename)
+    tmp = os.path.join(
+        os.path.dirname(filename), f".{os.path.basename(filename)}.{os.getpid()}.tmp"
+    )
+    try:
+        with open(tmp, "w", newline="") as file:
+            file.write(contents)
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def file_stat(filename: PathLike) -> Optional[List[int]]:
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def variables_key(names: List[str], config: Config) -> str:
+    values = [common.resolve(f"$({name})", config) for name in names]
+    return hashlib.sha1(json.dumps(values).encode("utf-8")).hexdigest()
+
+
+def replace_template(
+    src: PathLike, dst: PathLike, config: Config, state: ReplaceState
+) -> None:
+    key = os.fspath(dst)
+    entry = state.old_templates.get(key)
+    if entry is not None:
+        src_stat, dst_stat, names, values = entry
+        if (
+            [src_stat, dst_stat] == [file_stat(src), file_stat(dst)]
+            and variables_key(names, config) == values
+        ):
+            state.templates[key] = entry
+            return
+
+    names = replace_in_file_all(src, dst, config)
+    state.templates[key] = [
+        file_stat(src),
+        file_stat(dst),
+        names,
+        variables_key(names, config),
+    ]
+
+
+def replace_in_file_all(src: PathLike, dst: PathLike, config: Config) -> List[str]:
+    """Resolve all variables in src into dst, returns the referenced variables"""
     with open(src, "r", newline="") as file:
         contents = file.read()
 
+    names = sorted(set(common.VAR_PATTERN.findall(contents)))
     contents = common.resolve(contents, config)
 
-    with open(dst, "w", newline="") as file:
-        file.write(contents)
+    # untouched outputs keep their mtime so that nothing depending on them rebuilds
+    if read_text(dst) == contents:
+        print(f"Unchanged {dst!s}")
+        return names
+    print(f"Updating {src!s} -> {dst!s}")
+    write_text(dst, contents)
+    return names
 
 
 def replace_in_file(
     filename: PathLike, replacements: List[Substitution], config: Config
 ):
-    print(f"Updating {filename!s}")
-    with open(filename, "r", newline="") as file:
-        contents = file.read()
-    for replacement in replacements:
-        pattern = common.resolve(replacement.search, config)
-        repl = common.resolve(replacement.replace, config)
-        contents = re.sub(pattern, repl, contents)
-    with open(filename, "w", newline="") as file:
-        file.write(contents)
+    apply_plan(filename, compile_plan(replacements, config))
+
+
+def apply_plan(filename: PathLike, plan: SubstitutionPlan) -> FileResult:
+    result = process_file(filename, [plan])[0]
+    report_file(result)
+    if result.error is not None:
+        raise result.error
+    return result
+
+
+def process_file(filename: PathLike, plans: List[SubstitutionPlan]) -> List[FileResult]:
+    """Apply the plans one after another and write the file once"""
+    try:
+        with open(filename, "r", newline="") as file:
+            original = file.read()
+
+        contents = original
+        applied: List[Tuple[List[int], bool, List[bool]]] = []
+        for plan in plans:
+            new_contents, matches, ran = plan.apply(contents)
+            applied.append((matches, new_contents != contents, ran))
+            contents = new_contents
+
+        # matches that replace text with the same text don't count as changes
+        written = contents != original
+        if written:
+            write_text(filename, contents)
+        st = os.stat(filename)
+    except Exception as e:
+        return [FileResult(filename, [0] * len(p.rules), False, e) for p in plans]
+
+    results: List[FileResult] = []
+    for matches, changed, ran in applied:
+        result = FileResult(filename, matches, changed and written, ran=ran)
+        result.stat = (st.st_size, st.st_mtime_ns)
+        results.append(result)
+    return results
+
+
+def report_file(result: FileResult) -> None:
+    if result.skipped:
+        return
+    if result.error is not None:
+        print(f"Failed {result.filename!s}: {result.error}")
+    elif result.changed:
+        print(f"Updating {result.filename!s} ({sum(result.matches)} matches)")
+    else:
+        print(f"Unchanged {result.filename!s} ({sum(result.matches)} matches)")
+
+
+def report_matches(
+    pattern: str, plan: SubstitutionPlan, results: List[FileResult]
+) -> None:
+    changed = sum(result.changed for result in results)
+    skipped = sum(result.skipped for result in results)
+    failed = sum(result.error is not None for result in results)
+    summary = f"{pattern}: {changed} of {len(results)} files changed"
+    if skipped:
+        summary += f", {skipped} up to date"
+    if failed:
+        summary += f", {failed} failed"
+    processed = [result for result in results if result.ran]
+    prefiltered = sum(not any(result.ran) for result in processed)
+    if prefiltered:
+        summary += f", {prefiltered} without running any regex"
+    print(summary)
+    for i, rule in enumerate(plan.rules):
+        matches = sum(result.matches[i] for result in results)
+        files = sum(result.matches[i] > 0 for result in results)
+        print(f"    {matches} matches in {files} files: {rule.search}")
+        if rule.literal is None or not processed:
+            continue
+        ran = sum(result.ran[i] for result in processed)
+        hits = sum(result.matches[i] > 0 for result in processed)
+        print(
+            f"      prefilter {rule.literal!r} passed {ran} of {len(processed)} "
+            f"files, {hits} matched"
+        )
 
 
 def main():
@@ -80,9 +424,12 @@ def main():
 
     args = parser.parse_args()
 
-    config = common.load_config(args.config)
+    config = common.load_config(args.config, args.config_cache)
     with common.chdir(config.root):
-        replace(config)
+        run(config, args)
+
+    if args.verbose > 0:
+        common.print_stats()
 
 
 GROUP = re.compile(r"(?:\\g<(\d+)>|\\(\d+))")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from typing import Any, BinaryIO, Dict, List, Optional, Union
+
+from buildtools import client, common
+from buildtools.datatypes import Config, PathLike
+from buildtools.fsindex import FileSystemIndex
+
+logger = logging.getLogger(__name__)
+
+
+def run(config: Config, args: argparse.Namespace):
+    serve(args.config, args.idle_timeout)
+
+
+def build_parser(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--idle-timeout",
+        help="Shut down after this many seconds without requests",
+        dest="idle_timeout",
+        type=float,
+        default=None,
+    )
+    common.add_verbose_option(parser)
+
+
+class StreamWriter(io.TextIOBase):
+    def __init__(self, stream: BinaryIO, name: str):
+        self.stream = stream
+        self.name = name
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if s:
+            self.stream.write(json.dumps({self.name: s}).encode("utf-8") + b"\n")
+            self.stream.flush()
+        return len(s)
+
+
+def send(stream: BinaryIO, message: Dict[str, Any]) -> None:
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    server: BuildServer
+
+    def handle(self) -> None:
+        request = json.loads(self.rfile.readline())
+        stdout = StreamWriter(self.wfile, "stdout")
+        stderr = StreamWriter(self.wfile, "stderr")
+
+        # forward log records of the request to the client too
+        handler = logging.StreamHandler(stderr)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        root_logger = logging.getLogger()
+
+        root_logger.addHandler(handler)
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+                stderr
+            ):
+                code = self.server.execute(request["argv"], request["cwd"])
+        finally:
+            root_logger.removeHandler(handler)
+
+        send(self.wfile, {"exit": code})
+
+
+class BuildServer(socketserver.UnixStreamServer):
+    def __init__(self, path: str, config_file: str):
+        self.config_file = config_file
+        self.snapshot = common.load_config_snapshot(config_file)
+        self.requests = 0
+        self.reloads = 0
+        super().__init__(path, RequestHandler)
+
+    def current_config(self) -> Config:
+        # poll the config, props and their imports for changes on every request
+        if not self.snapshot.is_valid():
+            logger.info("Configuration changed, reloading %s", self.config_file)
+            self.snapshot = common.load_config_snapshot(self.config_file)
+            self.reloads += 1
+
+        # commands treat the config as immutable so it and its caches can be shared
+        config = self.snapshot.config
+        if not config.fs.persistent:
+            setattr(config, "_fs_index", FileSystemIndex(persistent=True))
+        else:
+            # files may have changed since the last request
+            config.fs.refresh()
+        return config
+
+    def execute(self, argv: List[str], cwd: str) -> Union[int, str]:
+        from buildtools import __main__ as cli
+
+        self.requests += 1
+        with common.chdir(cwd):
+            try:
+                parser, args = cli.parse_args(argv)
+            except SystemExit as e:
+                return exit_code(e)
+
+            if args.command == "serve" or os.path.normcase(
+                args.config
+            ) != os.path.normcase(self.config_file):
+                return client.UNAVAILABLE
+
+            try:
+                cli.execute(self.current_config(), args, parser)
+            except SystemExit as e:
+                return exit_code(e)
+            except Exception:
+                traceback.print_exc()
+                return 1
+
+        return 0
+
+
+def exit_code(e: SystemExit) -> int:
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def remove_stale_socket(path: str) -> None:
+    if not os.path.exists(path):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.remove(path)
+            return
+
+    raise RuntimeError(f"Build server is already listening on {path}")
+
+
+def make_runtime_dir(path: str) -> None:
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise RuntimeError(f"Build server directory {path} belongs to another user")
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+def serve(config_file: PathLike, idle_timeout: Optional[float] = None):
+    if not hasattr(socket, "AF_UNIX"):
+        raise RuntimeError("Build server requires Unix domain socket support")
+
+    config_file = os.path.abspath(config_file)
+    path = client.socket_path(config_file)
+    make_runtime_dir(os.path.dirname(path))
+    remove_stale_socket(path)
+
+    with BuildServer(path, config_file) as server:
+        server.timeout = idle_timeout
+        timed_out = False
+
+        def handle_timeout():
+            nonlocal timed_out
+            timed_out = True
+
+        server.handle_timeout = handle_timeout
+
+        print(f"Serving {config_file} on {path}")
+        sys.stdout.flush()
+        try:
+            while not timed_out:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+        print(
+            f"Build server shutting down after {server.requests} requests "
+            f"and {server.reloads} reloads"
+        )
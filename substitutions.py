@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+from typing import Any, Iterable, List, Optional, Tuple
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_constants
+    import sre_parse
+
+from buildtools import common
+from buildtools.datatypes import Config, Substitution
+
+
+def collect_literals(items: Any, literals: List[str]) -> None:
+    run: List[str] = []
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+
+        literals.append("".join(run))
+        run = []
+        if op is sre_constants.SUBPATTERN:
+            _, add_flags, _, pattern = av
+            if not add_flags & re.IGNORECASE:
+                collect_literals(pattern, literals)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] > 0:
+            collect_literals(av[2], literals)
+    literals.append("".join(run))
+
+
+def literal_prefix(items: Any) -> bool:
+    while len(items) > 0:
+        op, av = items[0]
+        if op is not sre_constants.SUBPATTERN or av[1] & re.IGNORECASE:
+            return op is sre_constants.LITERAL
+        items = av[3]
+    return False
+
+
+def prefilter_literal(regex: re.Pattern) -> Optional[str]:
+    """Longest literal substring that any string matched by regex contains
+
+    None if there is none or if the regex starts with a literal, re already searches
+    for literal prefixes as fast as str.__contains__ does.
+    """
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    if literal_prefix(parsed):
+        return None
+    literals: List[str] = []
+    collect_literals(parsed, literals)
+    return max(literals, key=len) or None
+
+
+class CompiledSubstitution(object):
+    """Substitution with its variables resolved and its pattern compiled"""
+
+    def __init__(self, search: str, replace: str):
+        self.search = search
+        self.replace = replace
+        self.regex = re.compile(search)
+        # the regex can't match contents that don't contain it
+        self.literal = prefilter_literal(self.regex)
+
+    def may_match(self, contents: str) -> bool:
+        return self.literal is None or self.literal in contents
+
+    def apply(self, contents: str) -> Tuple[str, int]:
+        return self.regex.subn(self.replace, contents)
+
+
+class SubstitutionPlan(object):
+    """Substitutions of a pattern prepared once and applied to every matched file
+
+    The substitutions are applied one after another. Merging them into a single
+    alternation is much slower with re: patterns starting with a literal use a fast
+    prefix search while an alternation is tried branch by branch at every position.
+    For the same reason the literals required by substitutions without a literal
+    prefix are looked up with str.__contains__ rather than a combined needle regex.
+    They are checked against the current contents so that substitutions introducing
+    a literal still work.
+    """
+
+    def __init__(self, rules: List[CompiledSubstitution]):
+        self.rules = rules
+        # changes whenever any resolved substitution does
+        self.key = hashlib.sha1(
+            json.dumps([(rule.search, rule.replace) for rule in rules]).encode("utf-8")
+        ).hexdigest()
+
+    def apply(self, contents: str) -> Tuple[str, List[int], List[bool]]:
+        """New contents, the number of matches of each substitution and whether its
+        regex ran at all"""
+        counts: List[int] = []
+        ran: List[bool] = []
+        for rule in self.rules:
+            if rule.may_match(contents):
+                contents, count = rule.apply(contents)
+                counts.append(count)
+                ran.append(True)
+            else:
+                counts.append(0)
+                ran.append(False)
+        return contents, counts, ran
+
+
+def compile_plan(
+    substitutions: Iterable[Substitution], config: Config
+) -> SubstitutionPlan:
+    return SubstitutionPlan(
+        [
+            CompiledSubstitution(
+                common.resolve(s.search, config), common.resolve(s.replace, config)
+            )
+            for s in substitutions
+        ]
+    )
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import stat as statmod
+import sys
+from typing import Any, Callable, Counter, Dict, Iterable, List, Optional, Tuple
+
+from buildtools.datatypes import PathLike
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+# tried in this order starting from the configured one, copy always works
+LINK_STRATEGIES = ("hardlink", "reflink", "copy_file_range", "copy")
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def path_key(path: PathLike) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def file_digest(path: PathLike) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def scan(root: pathlib.Path) -> Dict[str, Tuple[pathlib.Path, os.stat_result]]:
+    """Everything below root keyed by path_key, symlinks are not followed"""
+    entries: Dict[str, Tuple[pathlib.Path, os.stat_result]] = {}
+    try:
+        iterator = os.scandir(root)
+    except (FileNotFoundError, NotADirectoryError):
+        return entries
+
+    with iterator:
+        for entry in iterator:
+            path = root / entry.name
+            st = entry.stat(follow_symlinks=False)
+            entries[path_key(path)] = (path, st)
+            if statmod.S_ISDIR(st.st_mode):
+                entries.update(scan(path))
+    return entries
+
+
+def up_to_date(
+    src: pathlib.Path,
+    src_stat: os.stat_result,
+    dst: pathlib.Path,
+    dst_stat: os.stat_result,
+    checksum: bool = False,
+) -> bool:
+    if not statmod.S_ISREG(dst_stat.st_mode):
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+        return True
+    return checksum and file_digest(src) == file_digest(dst)
+
+
+def same_device(src: PathLike, dst: PathLike) -> bool:
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+    except OSError:
+        return False
+
+
+def reflink(src: PathLike, dst: PathLike) -> None:
+    import fcntl
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_range(src: PathLike, dst: PathLike) -> None:
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                # some filesystems and special files stop early, link_file falls back
+                raise OSError(f"copy_file_range stopped with {remaining} bytes left")
+            remaining -= copied
+
+
+def link_file(
+    src: PathLike,
+    dst: PathLike,
+    strategy: str = "copy",
+    copy_function: Callable[[str, str], Any] = shutil.copy2,
+) -> str:
+    """Put a copy of src at dst, returns the strategy that worked
+
+    Hardlinks and reflinks are only tried if both paths are on the same device. dst is
+    replaced atomically so that writing to a hardlinked dst never modifies its source.
+    """
+    if strategy not in LINK_STRATEGIES:
+        raise ValueError(
+            f"Invalid link strategy {strategy!r}, expected one of {LINK_STRATEGIES}"
+        )
+
+    src = os.fspath(src)
+    dst = os.fspath(dst)
+    # renaming a link onto another link of the same file is a no-op and would leave
+    # tmp behind, other strategies create a new file that replaces the old link
+    if strategy == "hardlink":
+        with contextlib.suppress(OSError):
+            if os.path.samefile(src, dst):
+                return strategy
+    shared = strategy != "copy" and same_device(src, dst)
+    tmp = os.path.join(
+        os.path.dirname(dst), f".{os.path.basename(dst)}.{os.getpid()}.tmp"
+    )
+
+    for candidate in LINK_STRATEGIES[LINK_STRATEGIES.index(strategy) :]:
+        if candidate in ("hardlink", "reflink") and not shared:
+            continue
+        if candidate == "reflink" and not sys.platform.startswith("linux"):
+            continue
+        if candidate == "copy_file_range" and not hasattr(os, "copy_file_range"):
+            continue
+
+        try:
+            if candidate == "hardlink":
+                os.link(src, tmp)
+            elif candidate == "reflink":
+                reflink(src, tmp)
+                shutil.copystat(src, tmp)
+            elif candidate == "copy_file_range":
+                copy_range(src, tmp)
+                shutil.copystat(src, tmp)
+            else:
+                copy_function(src, tmp)
+            os.replace(tmp, dst)
+            if os.path.lexists(tmp):
+                # dst was linked to src in the meantime
+                os.remove(tmp)
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if candidate == "copy":
+                raise
+            continue
+        return candidate
+
+    raise AssertionError("unreachable")
+
+
+def copy_file(src: pathlib.Path, dst: pathlib.Path, link: str = "copy") -> str:
+    # mtime is copied too so that the next sync can skip the file
+    return link_file(src, dst, link, shutil.copy2)
+
+
+def remove(path: pathlib.Path, st: os.stat_result) -> None:
+    if statmod.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class SyncResult(object):
+    def __init__(self) -> None:
+        self.copied: List[pathlib.Path] = []
+        self.skipped: List[pathlib.Path] = []
+        self.removed: List[pathlib.Path] = []
+        self.errors: List[Tuple[pathlib.Path, Exception]] = []
+        self.strategies: Counter[str] = collections.Counter()
+
+    def summary(self) -> str:
+        copied = f"{len(self.copied)} copied"
+        if set(self.strategies) - {"copy"}:
+            counts = ", ".join(f"{n} {s}" for s, n in self.strategies.most_common())
+            copied += f" ({counts})"
+        text = f"{copied}, {len(self.skipped)} unchanged, {len(self.removed)} removed"
+        if self.errors:
+            text += f", {len(self.errors)} failed"
+        return text
+
+    def raise_errors(self) -> None:
+        if not self.errors:
+            return
+        for path, error in self.errors:
+            logger.error("%s: %s", path, error)
+        raise RuntimeError(f"Failed to sync {len(self.errors)} files")
+
+
+def copy_files(
+    copies: Iterable[Tuple[pathlib.Path, pathlib.Path]],
+    jobs: int = 1,
+    link: str = "copy",
+    callback: Optional[Callable[[pathlib.Path, pathlib.Path, str], None]] = None,
+    result: Optional[SyncResult] = None,
+) -> SyncResult:
+    """Copy (src, dst) files on a thread pool, errors are collected per file"""
+    if result is None:
+        result = SyncResult()
+
+    def copy(src: pathlib.Path, dst: pathlib.Path) -> str:
+        strategy = copy_file(src, dst, link)
+        if callback is not None:
+            callback(src, dst, strategy)
+        return strategy
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [(dst, executor.submit(copy, src, dst)) for src, dst in copies]
+        for dst, future in futures:
+            try:
+                strategy = future.result()
+            except OSError as e:
+                result.errors.append((dst, e))
+            else:
+                result.copied.append(dst)
+                result.strategies[strategy] += 1
+
+    return result
+
+
+def mirror(
+    files: Iterable[Tuple[pathlib.Path, pathlib.Path]],
+    root: pathlib.Path,
+    jobs: int = 1,
+    checksum: bool = False,
+    callback: Optional[Callable[[pathlib.Path, pathlib.Path, str], None]] = None,
+    link: str = "copy",
+) -> SyncResult:
+    """Make root contain exactly the given (src, dst) files and directories
+
+    Files whose size and mtime (or with checksum, contents) match are skipped, the rest
+    are copied on a thread pool. Anything else below root is removed.
+    """
+    result = SyncResult()
+    existing = scan(root)
+    root.mkdir(parents=True, exist_ok=True)
+
+    copies: Dict[str, Tuple[pathlib.Path, pathlib.Path]] = {}
+    directories: Dict[str, pathlib.Path] = {}
+    for src, dst in files:
+        # parents of everything that is kept are kept too
+        parent = dst.parent
+        while path_key(parent) not in directories and parent != root:
+            directories[path_key(parent)] = parent
+            if parent == parent.parent:
+                break
+            parent = parent.parent
+
+        if os.path.isdir(src):
+            directories[path_key(dst)] = dst
+        else:
+            copies[path_key(dst)] = (src, dst)
+
+    # remove orphans and anything of the wrong type, deepest paths first
+    for key in sorted(existing, reverse=True):
+        path, st = existing[key]
+        is_dir = statmod.S_ISDIR(st.st_mode)
+        if is_dir and key in directories or not is_dir and key in copies:
+            continue
+        if not os.path.lexists(path):
+            continue
+        try:
+            remove(path, st)
+        except OSError as e:
+            result.errors.append((path, e))
+            continue
+        result.removed.append(path)
+        del existing[key]
+
+    for key, path in sorted(directories.items()):
+        if key not in existing:
+            path.mkdir(parents=True, exist_ok=True)
+
+    pending: List[Tuple[pathlib.Path, pathlib.Path]] = []
+    for key, (src, dst) in copies.items():
+        if key not in existing:
+            pending.append((src, dst))
+            continue
+
+        src_stat = os.stat(src)
+        dst_stat = existing[key][1]
+        if not up_to_date(src, src_stat, dst, dst_stat, checksum):
+            pending.append((src, dst))
+            continue
+
+        if src_stat.st_mtime_ns != dst_stat.st_mtime_ns:
+            # same contents, skip the checksum next time
+            shutil.copystat(src, dst)
+        result.skipped.append(dst)
+
+    copy_files(pending, jobs, link, callback, result)
+    return result
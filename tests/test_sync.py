@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import os
+import tempfile
+import unittest
+
+from buildtools import sync
+
+
+class LinkFileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.src = os.path.join(self.root, "src.dll")
+        self.dst = os.path.join(self.root, "dst.dll")
+        with open(self.src, "w") as file:
+            file.write("contents")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_hardlink_twice_leaves_no_temp_file(self) -> None:
+        for _ in range(2):
+            self.assertEqual(sync.link_file(self.src, self.dst, "hardlink"), "hardlink")
+        self.assertEqual(sorted(os.listdir(self.root)), ["dst.dll", "src.dll"])
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+
+    def test_copy_replaces_existing_hardlink(self) -> None:
+        sync.link_file(self.src, self.dst, "hardlink")
+        self.assertEqual(sync.link_file(self.src, self.dst, "copy"), "copy")
+        self.assertEqual(sorted(os.listdir(self.root)), ["dst.dll", "src.dll"])
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Copyright (c) 2022 Daumantas Kavolis
+
+   buildtools is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   buildtools is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with buildtools.  If not, see <http: //www.gnu.org/licenses/>.
+
+"""
+
+
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from buildtools.datatypes import PathLike
+
+logger = logging.getLogger(__name__)
+
+# runs kept in the history file of each target
+MAX_HISTORY = 20
+
+UNITS = {"us": 0.001, "ms": 1.0, "s": 1000.0}
+NUMBER = r"(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>us|ms|s)\b"
+# method signatures have a parameter list, phases don't
+METHOD_PATTERN = re.compile(r"[\w`<>\[\],.:/+]+\s*\(.*\)")
+# --log-timings prints phases and methods as "<name>: <time>" and lists the methods
+# of a phase as "<time> <signature>", other log lines are ignored
+NAMED_TIMING = re.compile(rf"^\s*(?P<name>\S.*?):\s*{NUMBER}\s*$")
+METHOD_TIMING = re.compile(rf"^\s*{NUMBER}\s+(?P<name>{METHOD_PATTERN.pattern})\s*$")
+
+
+class Timings(object):
+    """Milliseconds spent in each phase and method of a single bcl run"""
+
+    def __init__(
+        self,
+        phases: Optional[Dict[str, float]] = None,
+        methods: Optional[Dict[str, float]] = None,
+        date: Optional[str] = None,
+    ):
+        self.phases = phases or {}
+        self.methods = methods or {}
+        self.date = date or datetime.datetime.now().isoformat(timespec="seconds")
+
+    def __bool__(self) -> bool:
+        return bool(self.phases or self.methods)
+
+    def add(self, name: str, ms: float) -> None:
+        # methods are compiled once per target instruction set, report the sum
+        timings = self.methods if METHOD_PATTERN.search(name) else self.phases
+        timings[name] = timings.get(name, 0.0) + ms
+
+    def slowest(self, count: int) -> List[Tuple[str, float]]:
+        return sorted(self.methods.items(), key=lambda item: -item[1])[:count]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"date": self.date, "phases": self.phases, "methods": self.methods}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> Timings:
+        return Timings(data.get("phases"), data.get("methods"), data.get("date"))
+
+
+def parse(text: str) -> Timings:
+    timings = Timings()
+    for line in text.splitlines():
+        match = NAMED_TIMING.match(line) or METHOD_TIMING.match(line)
+        if match is not None:
+            ms = float(match.group("value")) * UNITS[match.group("unit")]
+            timings.add(match.group("name"), ms)
+    return timings
+
+
+class TimingHistory(object):
+    """Timings of the last MAX_HISTORY runs of a target, newest last"""
+
+    def __init__(self, filename: PathLike):
+        self.filename = filename
+        self.runs: List[Timings] = []
+        try:
+            with open(filename, "r") as file:
+                self.runs = [Timings.from_json(run) for run in json.load(file)]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError):
+            logger.warning("Ignoring unreadable timing history %s", filename)
+
+    def latest(self) -> Optional[Timings]:
+        return self.runs[-1] if self.runs else None
+
+    def append(self, timings: Timings) -> None:
+        self.runs.append(timings)
+        del self.runs[:-MAX_HISTORY]
+
+    def save(self) -> None:
+        try:
+            with open(self.filename, "w") as file:
+                json.dump([run.to_json() for run in self.runs], file, indent=2)
+        except OSError:
+            logger.warning("Failed to write timing history %s", self.filename)
+
+
+def differences(
+    current: Dict[str, float], previous: Dict[str, float]
+) -> List[Tuple[str, float, float]]:
+    """(name, previous, current) sorted by the largest absolute change first"""
+    names = set(current) | set(previous)
+    changes = [(n, previous.get(n, 0.0), current.get(n, 0.0)) for n in names]
+    return sorted(changes, key=lambda c: -abs(c[2] - c[1]))
+
+
+def format_change(name: str, before: float, after: float) -> str:
+    delta = after - before
+    percent = f" ({delta / before:+.0%})" if before > 0 else " (new)"
+    return f"    {after:10.1f} ms {delta:+10.1f} ms{percent} {name}"
+
+
+def report(
+    name: str, current: Timings, previous: Optional[Timings], count: int = 5
+) -> None:
+    phases = sum(current.phases.values())
+    methods = sum(current.methods.values())
+    print(
+        f"Burst timings of '{name}': {len(current.phases)} phases in {phases:.1f} ms, "
+        f"{len(current.methods)} methods in {methods:.1f} ms"
+    )
+
+    slowest = current.slowest(count)
+    if slowest:
+        print("  Slowest methods:")
+        for method, ms in slowest:
+            print(f"    {ms:10.1f} ms {method}")
+
+    if previous is None:
+        return
+
+    print(f"  Changes since {previous.date}:")
+    for kind, now, before in (
+        ("phase", current.phases, previous.phases),
+        ("method", current.methods, previous.methods),
+    ):
+        for change in differences(now, before)[:count]:
+            if change[1] == change[2]:
+                break
+            print(format_change(f"[{kind}] {change[0]}", change[1], change[2]))